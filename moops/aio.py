@@ -0,0 +1,171 @@
+import asyncio
+import socket
+
+from moops import bpf
+from moops.fling import Fling
+from moops.match import Match
+
+
+# Many Flings on one asyncio event loop instead of one thread each. Every
+# entry of 'flings' is a Fling configuration ('in', 'out', 'match',
+# 'mangle'). Entries sharing an input interface share its socket, and a
+# frame goes to the first of them whose match it equals, so one loop serves
+# any number of interface pairs and rules. The sockets are non-blocking and
+# registered with the loop, so stop() takes effect straight away instead of
+# after the next frame.
+#
+#   a = AsyncFling({'flings': [{'in': 'eth0', 'out': 'eth1', ...}, ...]})
+#   asyncio.run(a.serve())        # or a.run(); a.stop() from elsewhere
+
+class AsyncFling(dict):
+    __NAME__ = "name"
+    __FLINGS__ = "flings"
+    __FILTER__ = "filter"
+
+    __KEYS__ = [
+        __NAME__,
+        __FLINGS__,
+        __FILTER__
+        ]
+
+    # Frames sent nowhere, as the mangle gave nothing back or because the
+    # output socket was full
+    __DROPPED__ = Fling.__DROPPED__
+
+    __COUNTERS__ = Fling.__COUNTERS__
+
+    __BUFSIZE__ = Fling.__BUFSIZE__
+
+    # The most frames taken off one socket per wakeup, so a busy interface
+    # doesn't starve the others
+    __BURST__ = 64
+
+    _in = None
+    _out = None
+    _rules = None
+    itemlist = None
+    counters = None
+    loop = None
+    exit = None
+    do_exit = False
+
+    def __init__(self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        self.itemlist = super(AsyncFling, self).keys()
+        self.counters = dict((k, 0) for k in self.__COUNTERS__)
+
+    def __hash__(self):
+        return hash(tuple(sorted(self.items())))
+
+    # One socket per interface, and the (match, mangle, output socket) rules
+    # of every input interface
+    def bootstrap(self):
+        self._in = {}
+        self._out = {}
+        self._rules = {}
+
+        for f in self.get(self.__FLINGS__, []):
+            i = f[Fling.__IN__]
+            o = f[Fling.__OUT__]
+
+            if i not in self._in:
+                s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                  socket.htons(0x0800))
+                s.bind((i, 0))
+                s.setblocking(False)
+                self._in[i] = s
+                self._rules[i] = []
+
+            if o not in self._out:
+                s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+                s.bind((o, 0))
+                s.setblocking(False)
+                self._out[o] = s
+
+            self._rules[i].append((f.get(Fling.__MATCH__),
+                                   f.get(Fling.__MANGLE__),
+                                   self._out[o]))
+
+        if self.get(self.__FILTER__, True):
+            for i in self._in:
+                self.attach(i)
+
+    # An interface with a single rule can have its match run in the kernel
+    # (see Fling.attach())
+    def attach(self, i):
+        r = self._rules[i]
+        if len(r) != 1 or not isinstance(r[0][0], Match):
+            return
+
+        p = bpf.program(r[0][0])
+        if p is None:
+            return
+        bpf.attach(self._in[i], p)
+
+        try:
+            while True:
+                self._in[i].recv(self.__BUFSIZE__)
+        except BlockingIOError:
+            pass
+
+    # Called by the loop when the socket on interface i has frames waiting
+    def readable(self, i):
+        s = self._in[i]
+        rules = self._rules[i]
+        c = self.counters
+
+        for n in range(self.__BURST__):
+            try:
+                x = s.recv(self.__BUFSIZE__)
+            except BlockingIOError:
+                return
+            c[Fling.__RECEIVED__] += 1
+
+            for m, f, o in rules:
+                if m is None or not m == x:
+                    continue
+                c[Fling.__MATCHED__] += 1
+
+                if f is None:
+                    c[self.__DROPPED__] += 1
+                    break
+                x = f(x)
+                if x is None:
+                    c[self.__DROPPED__] += 1
+                    break
+                c[Fling.__MANGLED__] += 1
+
+                try:
+                    o.send(x)
+                    c[Fling.__SENT__] += 1
+                except BlockingIOError:
+                    c[self.__DROPPED__] += 1
+                break
+
+    async def serve(self):
+        self.exit = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+
+        try:
+            self.bootstrap()
+            for i, s in self._in.items():
+                self.loop.add_reader(s, self.readable, i)
+            if not self.do_exit:
+                await self.exit.wait()
+        finally:
+            for s in self._in.values():
+                self.loop.remove_reader(s)
+                s.close()
+            for s in self._out.values():
+                s.close()
+            self.loop = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    # Safe to call from any thread
+    def stop(self):
+        self.do_exit = True
+        l = self.loop
+        if l is not None:
+            l.call_soon_threadsafe(self.exit.set)
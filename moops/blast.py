@@ -0,0 +1,222 @@
+import time
+import random
+import socket
+from threading import Thread
+
+from moops import mmsg
+from moops.template import Template
+
+
+# Send a stream of crafted frames at a target rate. The frame comes from a
+# Template (or a layer chain, made into one), and 'vary' says how its fields
+# change from one frame to the next:
+#
+#   {"udp.src": ("seq", 1024, 65536),     # 1024, 1025, ... and round again
+#    "ip.ident": ("random",),             # anything the field can hold
+#    "ip.dst": ["10.0.0.1", "10.0.0.2"],  # each in turn
+#    "ip.ttl": lambda i: 64 - i % 8,      # a function of the frame number
+#    "ip.tos": 0x10}                      # always this
+#
+# Frames are paced to 'rate' per second (as fast as possible without one),
+# and handed over 'batch' at a time with one sendmmsg() call. With 'sink'
+# set, frames go to that (e.g. a Sink) instead of the 'out' interface.
+
+# Spec kinds
+SEQ = "seq"
+RANDOM = "random"
+
+
+class Sink:
+    # Keeps the last 'keep' frames it was given (all of them if None), and
+    # counts every one
+    def __init__(self, keep=None):
+        self.keep = keep
+        self.frames = []
+        self.pending = []
+        self.count = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, x):
+        self.pending.append(bytes(x))
+        return len(self.pending)
+
+    def full(self):
+        return False
+
+    def flush(self):
+        n = len(self.pending)
+        self.count += n
+        self.frames += self.pending
+        if self.keep is not None and len(self.frames) > self.keep:
+            del self.frames[:len(self.frames) - self.keep]
+        self.pending = []
+        return n
+
+
+class Blast(dict, Thread):
+    __OUT__ = "out"
+    __NAME__ = "name"
+    __TEMPLATE__ = "template"
+    __VARY__ = "vary"
+    __RATE__ = "rate"
+    __COUNT__ = "count"
+    __BATCH__ = "batch"
+    __SINK__ = "sink"
+
+    __KEYS__ = [
+        __OUT__,
+        __NAME__,
+        __TEMPLATE__,
+        __VARY__,
+        __RATE__,
+        __COUNT__,
+        __BATCH__,
+        __SINK__
+        ]
+
+    # Sleeping is only precise to a millisecond or so; closer to when the
+    # next batch is due than this, spin instead
+    __SPIN__ = 0.002
+
+    _out = None
+    itemlist = None
+    template = None
+    vary = None
+    sent = 0
+    started = None
+    stopped = None
+    do_exit = False
+
+    def __init__(self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        Thread.__init__(self)
+        self.itemlist = super(Blast, self).keys()
+        self.bootstrap()
+
+    # Thread keeps us in a set, and 'vary' holds dicts and functions, so hash
+    # by identity rather than by contents
+    def __hash__(self):
+        return id(self)
+
+    def bootstrap(self):
+        v = self.get(self.__VARY__, {})
+
+        t = self.get(self.__TEMPLATE__)
+        if t is None:
+            raise Exception("Blast: no template")
+        if not isinstance(t, Template):
+            t = Template(t, list(v))
+        self.template = t
+        self.vary = [(k, self.spec(k, s)) for k, s in v.items()]
+
+        if self.__SINK__ in self.itemlist:
+            return
+
+        s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+        s.bind((self[self.__OUT__], 0))
+        self._out = s
+
+    # Turn spec s for field k into a function of the frame number
+    def spec(self, k, s):
+        a, n, word, mask, shift = self.template.fields[k][:5]
+
+        if callable(s):
+            f = s
+        elif isinstance(s, list):
+            f = lambda i: s[i % len(s)]
+        elif isinstance(s, tuple) and s[0] == SEQ:
+            lo, hi = self.number(k, s[1]), self.number(k, s[2])
+            step = s[3] if len(s) > 3 else 1
+            if hi <= lo or step < 1:
+                raise Exception("Blast sequence for {0} must run up from "
+                                "{1} to {2} in steps of at least 1".format(
+                                    k, s[1], s[2]))
+            m = (hi - lo + step - 1) // step
+            f = lambda i: lo + (i % m) * step
+        elif isinstance(s, tuple) and s[0] == RANDOM:
+            if mask is None:
+                f = lambda i: random.getrandbits(8 * n)
+            else:
+                b = (mask >> shift).bit_length()
+                f = lambda i: random.getrandbits(b)
+        else:
+            return lambda i: s
+
+        # Address and payload fields are patched as bytes
+        if mask is None:
+            return lambda i: self.pack(f(i), n)
+        return f
+
+    # A sequence bound, with addresses taken as the number they spell
+    def number(self, k, v):
+        if isinstance(v, str):
+            v = self.template.encode(k, v)
+        if isinstance(v, (bytes, bytearray)):
+            v = int.from_bytes(v, "big")
+        return v
+
+    def pack(self, v, n):
+        if isinstance(v, int):
+            return v.to_bytes(n, "big")
+        return v
+
+    def values(self, i):
+        return dict((k, f(i)) for k, f in self.vary)
+
+    def run(self):
+        tx = self.get(self.__SINK__)
+        n = int(self.get(self.__BATCH__, 1))
+        if tx is None:
+            tx = mmsg.Batch(self._out, n)
+
+        rate = self.get(self.__RATE__)
+        count = self.get(self.__COUNT__)
+        t = self.template
+
+        i = 0
+        self.sent = 0
+        self.started = time.monotonic()
+        self.stopped = None
+
+        while not self.do_exit and (count is None or i < count):
+            m = n
+            if count is not None:
+                m = min(m, count - i)
+            for j in range(m):
+                tx.put(t.patch(self.values(i)))
+                i += 1
+            self.sent += tx.flush()
+
+            if rate:
+                self.wait(self.started + i / rate)
+
+        self.stopped = time.monotonic()
+
+    # Sleep most of the way to due, then spin the rest
+    def wait(self, due):
+        d = due - time.monotonic()
+        if d > self.__SPIN__:
+            time.sleep(d - self.__SPIN__)
+        while time.monotonic() < due:
+            pass
+
+    # How many frames went out, over how long, and at what rate
+    def report(self):
+        if self.started is None:
+            return None
+
+        e = (self.stopped or time.monotonic()) - self.started
+        r = 0
+        if e > 0:
+            r = self.sent / e
+        return {
+            "sent": self.sent,
+            "elapsed": e,
+            "rate": r,
+            "target": self.get(self.__RATE__),
+            }
+
+    def join(self):
+        self.do_exit = True
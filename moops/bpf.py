@@ -0,0 +1,173 @@
+import ctypes
+import socket
+import struct
+
+from moops import codec
+
+
+# Classic BPF, as attached to a socket with SO_ATTACH_FILTER. A Match that
+# flattened its template (see Match.compile()) translates almost one for one:
+# every (layer, offset, word, mask, value) test becomes a load, an optional
+# and, and a jump to the reject return if the value differs. The kernel then
+# only hands us frames that could possibly match, and Match still has the
+# final word on every frame that gets through.
+
+SO_ATTACH_FILTER = getattr(socket, "SO_ATTACH_FILTER", 26)
+SO_DETACH_FILTER = getattr(socket, "SO_DETACH_FILTER", 27)
+
+# struct sock_filter
+INSN = struct.Struct("HBBI")
+
+# Opcodes we emit
+LD_ABS = {1: 0x30, 2: 0x28, 4: 0x20}
+LD_IND = {1: 0x50, 2: 0x48, 4: 0x40}
+LD_LEN = 0x80
+LDX_MSH = 0xb1
+AND_K = 0x54
+SUB_X = 0x1c
+TXA = 0x87
+JEQ_K = 0x15
+JGE_K = 0x35
+RET_K = 0x06
+
+# How much of a frame the filter lets through
+ACCEPT = 0x40000
+
+# The most payload worth testing word by word; past that only the length is
+# checked and Match compares the rest
+PAYLOAD = 32
+
+# Jump targets, resolved once the program is laid out
+__ACCEPT__ = "accept"
+__REJECT__ = "reject"
+
+
+# Translate a Match into a list of (code, jt, jf, k) instructions, or None
+# if its template can't be flattened.
+def program(m):
+    if not m.compiled:
+        m.compile()
+    if m.tests is None:
+        return None
+
+    tests = list(m.tests)
+    if m.tail is not None:
+        l, v = m.tail
+        tests += payload(l, v[:PAYLOAD])
+
+    p = []
+    starts = layers(m.hops)
+    x = None
+    for l, o, w, mask, v in tests:
+        if l >= len(starts):
+            # Past a second variable length header; leave it to Match
+            break
+
+        d, c = starts[l]
+        if d is not None and x != d:
+            p += loadx(d)
+            x = d
+
+        if d is None:
+            p.append((LD_ABS[w.size], 0, 0, c + o))
+        else:
+            p.append((LD_IND[w.size], 0, 0, c + o))
+
+        if mask != (1 << (8 * w.size)) - 1:
+            p.append((AND_K, 0, 0, mask))
+        p.append((JEQ_K, 0, __REJECT__, v))
+
+    # The payload must end the frame exactly
+    if m.tail is not None and m.tail[0] < len(starts):
+        l, v = m.tail
+        d, c = starts[l]
+        if d is not None and x != d:
+            p += loadx(d)
+        p.append((LD_LEN, 0, 0, 0))
+        if d is not None:
+            p.append((SUB_X, 0, 0, 0))
+        p.append((JEQ_K, 0, __REJECT__, c + len(v)))
+
+    p.append((RET_K, 0, 0, ACCEPT))
+    p.append((RET_K, 0, 0, 0))
+    return resolve(p)
+
+
+# X = 4 * (P[d] & 0xf), the length of the IP header at d. Anything shorter
+# than a bare header is odd enough to hand to Match as is.
+def loadx(d):
+    return [
+        (LDX_MSH, 0, 0, d),
+        (TXA, 0, 0, 0),
+        (JGE_K, 0, __ACCEPT__, codec.IP.size),
+        ]
+
+
+# Where each layer starts, as (d, c): c bytes past the start of the frame,
+# or c bytes past X when d is the offset of the IP header X is read from.
+# Only one variable length header is supported; layers past a second one are
+# left out.
+def layers(hops):
+    s = []
+    d = None
+    c = 0
+    for h in hops:
+        s.append((d, c))
+        if h is not None:
+            c += h
+            continue
+        if d is not None:
+            break
+        d = c
+    else:
+        s.append((d, c))
+    return s
+
+
+# The leading payload bytes, as tests on its layer
+def payload(l, v):
+    t = []
+    o = 0
+    while o < len(v):
+        w = 4
+        while w > len(v) - o:
+            w >>= 1
+        t.append((l, o, codec.WORDS[w], (1 << (8 * w)) - 1,
+                  int.from_bytes(v[o:o+w], "big")))
+        o += w
+    return t
+
+
+def resolve(p):
+    a = len(p) - 2
+    r = len(p) - 1
+    out = []
+    for i, (code, jt, jf, k) in enumerate(p):
+        if jt == __ACCEPT__:
+            jt = a - i - 1
+        elif jt == __REJECT__:
+            jt = r - i - 1
+        if jf == __ACCEPT__:
+            jf = a - i - 1
+        elif jf == __REJECT__:
+            jf = r - i - 1
+        if jt > 255 or jf > 255:
+            raise Exception("BPF program too long to jump across")
+        out.append((code, jt, jf, k))
+    return out
+
+
+def pack(p):
+    return b''.join(INSN.pack(*i) for i in p)
+
+
+# Attach program p to socket s. The kernel copies the program, so the buffer
+# only has to outlive the call.
+def attach(s, p):
+    b = ctypes.create_string_buffer(pack(p))
+    fprog = struct.pack("HL", len(p), ctypes.addressof(b))
+    s.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def detach(s):
+    s.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
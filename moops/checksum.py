@@ -0,0 +1,117 @@
+import sys
+import struct
+
+from moops import codec
+
+# NumPy is optional; without it, its backend simply isn't offered
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# The Internet checksum (RFC 1071) is the one's complement of the one's
+# complement sum of the data as big-endian 16-bit words, an odd trailing byte
+# being padded with a zero on the right. Every backend below returns that sum,
+# folded to 16 bits; they only differ in how fast they get there for a given
+# buffer size.
+
+
+# Fold the carries of a one's complement sum back into 16 bits
+def fold(s):
+    while (s >> 16) != 0:
+        s = (s & 0xffff) + (s >> 16)
+    return s
+
+
+# Unpack every word at once
+def sum_struct(b):
+    n = len(b) >> 1
+    s = sum(struct.unpack_from("!%dH" % n, b))
+    if len(b) & 1:
+        s += b[-1] << 8
+    return fold(s)
+
+
+# Sum the buffer as native machine words; the one's complement sum is byte
+# order independent, so a little-endian result only needs its bytes swapped.
+def sum_memoryview(b):
+    m = memoryview(b)
+    n = len(m) & ~1
+    s = fold(sum(m[:n].cast("H")))
+    if sys.byteorder == "little":
+        s = ((s & 0xff) << 8) | (s >> 8)
+    if n != len(m):
+        s = fold(s + (m[n] << 8))
+    return s
+
+
+# As 2^16 = 1 (mod 2^16 - 1), the whole buffer read as one big-endian integer
+# is congruent to the sum of its words. The reduction runs entirely in C, so
+# this wins once there's more than a handful of words.
+def sum_bigint(b):
+    x = int.from_bytes(b, "big")
+    if len(b) & 1:
+        x <<= 8
+    s = x % 0xffff
+    # One's complement has two zeroes; a non-zero sum folds to 0xffff
+    if s == 0 and x != 0:
+        s = 0xffff
+    return s
+
+
+def sum_numpy(b):
+    n = len(b) & ~1
+    s = int(numpy.frombuffer(b, dtype=">u2", count=n >> 1).sum(
+        dtype=numpy.uint64))
+    if n != len(b):
+        s += b[-1] << 8
+    return fold(s)
+
+
+BACKENDS = {
+    "struct": sum_struct,
+    "memoryview": sum_memoryview,
+    "bigint": sum_bigint,
+}
+
+if numpy is not None:
+    BACKENDS["numpy"] = sum_numpy
+
+# Big integer reduction beats unpacking words at every size, header sized
+# buffers included. NumPy only pays off its call overhead on buffers at least
+# this large. See tests/checksum.py for the numbers behind both.
+LARGE = 1024
+
+
+# The folded one's complement sum of b, via the fastest backend for its size
+def sum16(b):
+    if numpy is not None and len(b) >= LARGE:
+        return sum_numpy(b)
+    return sum_bigint(b)
+
+
+# The Internet checksum of b. s is an already computed sum (e.g. of a pseudo
+# header) to fold in, so it needn't be concatenated with the data first.
+def compute(b, s=0):
+    return ~fold(sum16(b) + s) & 0xffff
+
+
+# Incrementally update checksum c for the 16-bit words of old that became new,
+# per RFC 1624, eqn. 3:
+#
+#   HC' = ~(~HC + ~m + m')
+#
+# Only words that actually differ contribute, but every word of old and new
+# is compared, so the cost is proportional to the length of the slice passed
+# in, not of the data the checksum covers. old and new must be the same, even,
+# length and must not include the checksum field itself.
+def update(c, old, new):
+    s = ~c & 0xffff
+    for i in range(0, len(old), 2):
+        m = codec.SHORT.unpack_from(old, i)[0]
+        n = codec.SHORT.unpack_from(new, i)[0]
+        if m != n:
+            s += (~m & 0xffff) + n
+
+    return ~fold(s) & 0xffff
@@ -0,0 +1,183 @@
+import socket
+import struct
+import threading
+from functools import lru_cache
+
+
+# Each fixed header is described by one precompiled Struct, so a layer can be
+# decoded with a single unpack_from() and encoded with a single pack_into()
+# instead of walking the header a field at a time.
+
+# dst, src, type
+ETHER = struct.Struct("!6s6sH")
+
+# vhl, tos, length, ident, flags/offset, ttl, protocol, checksum, src, dst
+IP = struct.Struct("!BBHHHBBH4s4s")
+
+# src, dst, length, checksum
+UDP = struct.Struct("!HHHH")
+
+# src, dst, zero, protocol, length
+PSEUDO = struct.Struct("!4s4sBBH")
+
+# Lone words, for reading or patching a single field in place
+BYTE = struct.Struct("!B")
+SHORT = struct.Struct("!H")
+LONG = struct.Struct("!I")
+
+# Where each field lives within its header: (offset, size, mask, shift).
+# Fields sharing bytes with another one are picked out by the mask, once the
+# value has been shifted into place. Options and addresses are compared as
+# raw bytes, so they carry no mask.
+ETHER_FIELDS = {
+    "dst": (0, 6, None, 0),
+    "src": (6, 6, None, 0),
+    "type": (12, 2, 0xffff, 0),
+    }
+
+IP_FIELDS = {
+    "version": (0, 1, 0xf0, 4),
+    "ihl": (0, 1, 0x0f, 0),
+    "tos": (1, 1, 0xff, 0),
+    "length": (2, 2, 0xffff, 0),
+    "ident": (4, 2, 0xffff, 0),
+    "flags": (6, 2, 0xe000, 13),
+    "offset": (6, 2, 0x1fff, 0),
+    "ttl": (8, 1, 0xff, 0),
+    "protocol": (9, 1, 0xff, 0),
+    "checksum": (10, 2, 0xffff, 0),
+    "src": (12, 4, None, 0),
+    "dst": (16, 4, None, 0),
+    "options": (20, None, None, 0),
+    }
+
+UDP_FIELDS = {
+    "src": (0, 2, 0xffff, 0),
+    "dst": (2, 2, 0xffff, 0),
+    "length": (4, 2, 0xffff, 0),
+    "checksum": (6, 2, 0xffff, 0),
+    }
+
+# Word readers by size, for comparing a field in place
+WORDS = {
+    1: BYTE,
+    2: SHORT,
+    4: LONG,
+    }
+
+
+# While a Mangle works out a flow plan, every header field assigned on its
+# thread is noted in 'log', as (layer, field); see Mangle.plan()
+class Assignments(threading.local):
+    log = None
+
+
+ASSIGNED = Assignments()
+
+
+def mac_ntoa(b):
+    return b.hex(':')
+
+
+# How many text forms of each kind of address are kept. The addresses a
+# layer is built with are usually a few hosts over and over, so a small cache
+# spares nearly all of the formatting and parsing.
+__INTERN__ = 4096
+
+
+# An address in wire form, from its text or (see MAC and IPv4 below) its
+# number
+def mac_aton(s):
+    if isinstance(s, int):
+        return s.to_bytes(6, "big")
+    return mac_packed(s)
+
+
+def ip_aton(s):
+    if isinstance(s, int):
+        return s.to_bytes(4, "big")
+    return ip_packed(s)
+
+
+@lru_cache(maxsize=__INTERN__)
+def mac_packed(s):
+    # Fast path for the canonical "aa:bb:cc:dd:ee:ff" form
+    if len(s) == 17:
+        return bytes.fromhex(s.replace(':', ''))
+    return bytes([int(i, 16) for i in s.split(':')])
+
+
+@lru_cache(maxsize=__INTERN__)
+def ip_packed(s):
+    return socket.inet_aton(s)
+
+
+@lru_cache(maxsize=__INTERN__)
+def mac_text(v):
+    return v.to_bytes(6, "big").hex(':')
+
+
+def mac_value(s):
+    return int.from_bytes(mac_packed(s), "big")
+
+
+@lru_cache(maxsize=__INTERN__)
+def ip_text(v):
+    return socket.inet_ntoa(v.to_bytes(4, "big"))
+
+
+def ip_value(s):
+    return int.from_bytes(ip_packed(s), "big")
+
+
+# Addresses held as the number they spell on the wire, for layers parsed
+# with 'numeric' set. Nothing is formatted until the text is asked for (by
+# str() or format()), and then it comes out of the caches above. They
+# compare equal to their text form as well as to their number, so templates
+# and code written with strings keep working, but hash as the number.
+class MAC(int):
+    def __str__(self):
+        return mac_text(self)
+
+    def __repr__(self):
+        return "MAC('{0}')".format(mac_text(self))
+
+    def __eq__(self, x):
+        if isinstance(x, str):
+            try:
+                x = mac_value(x)
+            except ValueError:
+                return False
+        return int.__eq__(self, x)
+
+    def __ne__(self, x):
+        r = self.__eq__(x)
+        if r is NotImplemented:
+            return r
+        return not r
+
+    __hash__ = int.__hash__
+
+
+class IPv4(int):
+    def __str__(self):
+        return ip_text(self)
+
+    def __repr__(self):
+        return "IPv4('{0}')".format(ip_text(self))
+
+    def __eq__(self, x):
+        if isinstance(x, str):
+            try:
+                x = ip_value(x)
+            except OSError:
+                return False
+        return int.__eq__(self, x)
+
+    def __ne__(self, x):
+        r = self.__eq__(x)
+        if r is NotImplemented:
+            return r
+        return not r
+
+    __hash__ = int.__hash__
@@ -0,0 +1,271 @@
+import socket
+
+from moops import codec
+from moops import checksum
+from moops.ether import Ether as EtherLayer
+from moops.ip import IP as IPLayer
+from moops.udp import UDP as UDPLayer
+
+
+# Compact versions of the Ether, IP and UDP layers, for when there are a
+# great many headers alive at once (queued, cached, captured). Each holds
+# only its header fields and 'next', in fixed __slots__, rather than a whole
+# dict plus bookkeeping keys, and is a fraction of the size. Fields are
+# still read and set as h['src'] (or h.src); a field that was never set is
+# missing, just as with the dict layers, and takes the same default when the
+# header is serialized.
+#
+#   i = compact.IP.decode(x, 14)        # or compact.IP(src=..., next=...)
+#   bytes(compact.Ether(next=i))
+#
+# layer() and compact() convert a chain to and from the dict layers.
+
+
+class Header:
+    __slots__ = ()
+
+    # The dict layer we stand in for
+    __LAYER__ = None
+
+    def __init__(self, *args, **kw):
+        for k, v in dict(*args, **kw).items():
+            self[k] = v
+
+    def __getitem__(self, k):
+        if k not in self.__slots__:
+            raise KeyError(k)
+        try:
+            return getattr(self, k)
+        except AttributeError:
+            raise KeyError(k)
+
+    def __setitem__(self, k, v):
+        if k not in self.__slots__:
+            raise KeyError(k)
+        setattr(self, k, v)
+
+    def __delitem__(self, k):
+        if k not in self:
+            raise KeyError(k)
+        delattr(self, k)
+
+    def __contains__(self, k):
+        return k in self.__slots__ and hasattr(self, k)
+
+    def get(self, k, d=None):
+        if k in self:
+            return getattr(self, k)
+        return d
+
+    def keys(self):
+        return [k for k in self.__slots__ if hasattr(self, k)]
+
+    def values(self):
+        return [getattr(self, k) for k in self.keys()]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, x):
+        if not hasattr(x, "items"):
+            return NotImplemented
+        return dict(self.items()) == dict(x.items())
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, dict(self.items()))
+
+    def __bytes__(self):
+        return self.pack(None)
+
+    # The serialized upper layer. We're passed along to it, for anything it
+    # needs from us (e.g. UDP's pseudo header).
+    def payload(self):
+        n = getattr(self, "next", None)
+        if n is None:
+            return b''
+        if isinstance(n, Header):
+            return n.pack(self)
+        return bytes(n)
+
+    # The equivalent dict layer chain
+    def layer(self):
+        d = {}
+        for k, v in self.items():
+            if isinstance(v, Header):
+                v = v.layer()
+            d[k] = v
+        l = self.__LAYER__(d)
+
+        n = d.get("next")
+        if isinstance(n, UDPLayer):
+            n["prev"] = l
+        return l
+
+
+class Ether(Header):
+    __slots__ = ("dst", "src", "type", "next")
+    __LAYER__ = EtherLayer
+
+    @classmethod
+    def decode(cls, b, o=0):
+        h = cls.__new__(cls)
+        dst, src, h.type = codec.ETHER.unpack_from(b, o)
+        h.dst = codec.mac_ntoa(dst)
+        h.src = codec.mac_ntoa(src)
+        h.next = b[o + codec.ETHER.size:]
+        return h
+
+    def pack(self, prev):
+        n = self.payload()
+        return codec.ETHER.pack(self.mac("dst"), self.mac("src"),
+                                getattr(self, "type", 0x0800)) + n
+
+    def mac(self, k):
+        v = getattr(self, k, None)
+        if v is None:
+            return EtherLayer.__EMPTY__
+        return codec.mac_aton(v)
+
+
+class IP(Header):
+    __slots__ = ("version", "ihl", "tos", "length", "ident", "flags",
+                 "offset", "ttl", "protocol", "checksum", "src", "dst",
+                 "options", "next")
+    __LAYER__ = IPLayer
+
+    @classmethod
+    def decode(cls, b, o=0):
+        h = cls.__new__(cls)
+        # The length and checksum are left unset, to be worked out afresh
+        # when we're packed, so changing a field never leaves them stale.
+        # The payload stops where the length says, short of any padding.
+        (vhl, h.tos, n, h.ident, foff, h.ttl, h.protocol, c,
+         src, dst) = codec.IP.unpack_from(b, o)
+        h.version = vhl >> 4
+        h.ihl = vhl & 0x0f
+        h.flags = foff >> 13
+        h.offset = foff & 0x1fff
+        h.src = socket.inet_ntoa(src)
+        h.dst = socket.inet_ntoa(dst)
+
+        p = o + codec.IP.size
+        l = h.ihl * 4
+        if l > codec.IP.size:
+            h.options = [b[p:o + l]]
+            p = o + l
+        h.next = b[p:o + max(n, p - o)]
+        return h
+
+    def pack(self, prev):
+        o = b''.join(getattr(self, "options", ()))
+        if o:
+            ihl = (codec.IP.size + len(o) + 3) // 4
+        else:
+            ihl = getattr(self, "ihl", 5)
+
+        n = self.payload()
+        l = getattr(self, "length", None)
+        if l is None:
+            l = ihl * 4 + len(n)
+            if l & 1:
+                l += 1
+                n += b'\0'
+
+        h = bytearray(codec.IP.size + len(o))
+        codec.IP.pack_into(h, 0,
+                           (getattr(self, "version", 4) << 4) | ihl,
+                           getattr(self, "tos", 0),
+                           l,
+                           getattr(self, "ident", 0),
+                           ((getattr(self, "flags", 0) & 0x07) << 13) |
+                           getattr(self, "offset", 0),
+                           getattr(self, "ttl", IPLayer.__DEFAULT_TTL__),
+                           getattr(self, "protocol", 17),
+                           0,
+                           self.addr("src"),
+                           self.addr("dst"))
+        h[codec.IP.size:] = o
+
+        c = getattr(self, "checksum", None)
+        if c is None:
+            c = checksum.compute(h)
+        codec.SHORT.pack_into(h, 10, c)
+        return bytes(h) + n
+
+    def addr(self, k):
+        return codec.ip_aton(getattr(self, k, IPLayer.__LOCALHOST__))
+
+    def pseudoheader(self, l):
+        return codec.PSEUDO.pack(self.addr("src"), self.addr("dst"), 0,
+                                 getattr(self, "protocol", 17), l)
+
+
+class UDP(Header):
+    __slots__ = ("src", "dst", "length", "checksum", "next")
+    __LAYER__ = UDPLayer
+
+    @classmethod
+    def decode(cls, b, o=0):
+        # As for IP, the length and checksum are worked out when we're packed
+        h = cls.__new__(cls)
+        h.src, h.dst, n, c = codec.UDP.unpack_from(b, o)
+        h.next = b[o + codec.UDP.size:o + max(n, codec.UDP.size)]
+        return h
+
+    def pack(self, prev):
+        n = self.payload()
+        l = getattr(self, "length", None)
+        if l is None:
+            l = codec.UDP.size + len(n)
+            if l & 1:
+                l += 1
+                n += b'\0'
+
+        b = bytearray(codec.UDP.size + len(n))
+        codec.UDP.pack_into(b, 0, getattr(self, "src", 53),
+                            getattr(self, "dst", 53), l, 0)
+        b[codec.UDP.size:] = n
+
+        c = getattr(self, "checksum", None)
+        if c is None:
+            c = 0
+            # Without a network header there's no pseudo header to sum, and
+            # zero means "no checksum"
+            if hasattr(prev, "pseudoheader"):
+                c = checksum.compute(
+                    b, checksum.sum16(prev.pseudoheader(len(b)))) or 0xffff
+        codec.SHORT.pack_into(b, 6, c)
+        return bytes(b)
+
+
+COMPACT = {
+    EtherLayer: Ether,
+    IPLayer: IP,
+    UDPLayer: UDP,
+    }
+
+
+# The compact equivalent of a dict layer chain
+def compact(l):
+    c = COMPACT[type(l)]
+    h = c.__new__(c)
+    for k in c.__slots__:
+        if k not in l:
+            continue
+        v = l[k]
+        if type(v) in COMPACT:
+            v = compact(v)
+        setattr(h, k, v)
+
+    # A parsed layer keeps its payload aside
+    if "next" not in l and l.next():
+        h.next = l.next()
+    return h
@@ -0,0 +1,61 @@
+from moops.ether import Ether
+from moops.ip import IP
+from moops.udp import UDP
+
+
+# Which layer follows which, by the field of the lower layer that says so:
+# Ether by its type, IP by its protocol. A frame decoded through a Dispatch
+# comes back as its Ether layer alone; each layer above is only decoded when
+# its 'next' is first read, so a frame looked at no further than its IP
+# header never has its UDP header decoded at all.
+#
+#   e = dispatch.decode(x)
+#   e['next']['src']                  # decodes the IP header, not the UDP
+#
+# More layers are added with register(), e.g.
+#
+#   dispatch.DEFAULT.register(IP, 6, TCP)
+
+
+class Dispatch:
+    # The field of each lower layer that names its upper layer
+    __FIELDS__ = {
+        Ether: Ether.__TYPE__,
+        IP: IP.__PROTOCOL__,
+        }
+
+    def __init__(self):
+        self.tables = {}
+
+    # Decode what follows a 'layer' whose field holds 'value' as 'upper'
+    def register(self, layer, value, upper):
+        if layer not in self.__FIELDS__:
+            raise Exception("Can't dispatch on {0}".format(layer.__name__))
+        self.tables.setdefault(layer, {})[value] = upper
+
+    # The layer class for what follows l, if we know it
+    def upper(self, l):
+        t = self.tables.get(type(l))
+        if t is None:
+            return None
+
+        # Only the first fragment of a datagram holds its header
+        if isinstance(l, IP) and l[IP.__OFFSET__]:
+            return None
+
+        return t.get(l[self.__FIELDS__[type(l)]])
+
+    def decode(self, x, lazy=True, numeric=False):
+        return Ether({Ether.__BYTES__: x,
+                      Ether.__LAZY__: lazy,
+                      Ether.__NUMERIC__: numeric,
+                      Ether.__DISPATCH__: self})
+
+
+DEFAULT = Dispatch()
+DEFAULT.register(Ether, 0x0800, IP)
+DEFAULT.register(IP, 17, UDP)
+
+
+def decode(x, lazy=True, numeric=False):
+    return DEFAULT.decode(x, lazy, numeric)
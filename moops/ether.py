@@ -1,3 +1,6 @@
+from moops import codec
+
+
 class Ether(dict):
     # Exported types
     __SRC__ = "src"
@@ -16,28 +19,47 @@ class Ether(dict):
 
     # Internal
     __BYTES__ = "bytes"
-    __INT_PTR__ = "__ptr"
     __NEXTDATA__ = "__next"
+    __LAZY__ = "lazy"
+    __NUMERIC__ = "numeric"
+    __DISPATCH__ = "dispatch"
 
     __SKIP__ = [
         __NAME__,
         __NEXT__,
         __BYTES__,
-        __NEXTDATA__
+        __NEXTDATA__,
+        __LAZY__,
+        __NUMERIC__,
+        __DISPATCH__
+        ]
+
+    # Header fields, as opposed to bookkeeping keys
+    __FIELDS__ = [
+        __SRC__,
+        __DST__,
+        __TYPE__
         ]
 
     __EMPTY__ = bytes(6)
 
     itemlist = None
     inbound = False
+    dirty = False
+    lazy = False
+    numeric = False
+    dispatch = None
 
     def __init__(self, *args, **kw):
         dict.__init__(self, *args, **kw)
         self.itemlist = super(Ether, self).keys()
-        self[self.__NAME__] = 'Ether'
+        dict.__setitem__(self, self.__NAME__, 'Ether')
 
         if self.__BYTES__ in self.itemlist:
             self.inbound = True
+            self.lazy = bool(dict.get(self, self.__LAZY__))
+            self.numeric = bool(dict.get(self, self.__NUMERIC__))
+            self.dispatch = dict.get(self, self.__DISPATCH__)
             self.parse()
 
     def __iter__(self):
@@ -50,12 +72,54 @@ class Ether(dict):
 
             yield i
 
+    # Track whether a parsed header has been touched, so an untouched one can
+    # be handed back without being rebuilt
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, v)
+        if k in self.__FIELDS__:
+            self.dirty = True
+            if codec.ASSIGNED.log is not None:
+                codec.ASSIGNED.log.append((self, k))
+
+    # In lazy mode a field is only decoded from the received bytes the first
+    # time it's read, and then cached like any other key. So is the upper
+    # layer, when we were parsed through a dispatch table.
+    def __missing__(self, k):
+        if k == self.__NEXT__:
+            return self.upper()
+        if not self.lazy or k not in self.__FIELDS__:
+            raise KeyError(k)
+        v = self.parsefield(k)
+        dict.__setitem__(self, k, v)
+        return v
+
+    def __contains__(self, k):
+        if dict.__contains__(self, k):
+            return True
+        if k == self.__NEXT__:
+            if self.dispatch is None:
+                return False
+        elif not self.lazy or k not in self.__FIELDS__:
+            return False
+        try:
+            self[k]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, k, d=None):
+        if k in self:
+            return self[k]
+        return d
+
     def __hash__(self):
         return hash(tuple(sorted(self.items())))
 
     def __eq__(self, x):
-        e = Ether({self.__BYTES__: x})
-        e.parse()
+        # Only the fields we compare against get decoded, and addresses are
+        # compared as numbers
+        e = Ether({self.__BYTES__: x, self.__LAZY__: True,
+                   self.__NUMERIC__: True})
         for i in self.itemlist:
             if i in self.__SKIP__:
                 continue
@@ -68,13 +132,41 @@ class Ether(dict):
         return True
 
     def __bytes__(self):
-        b = b''
-        b += self.convert(self.__DST__)
-        b += self.convert(self.__SRC__)
-        b += self.convert(self.__TYPE__)
-        b += self.getnext()
-        self[self.__BYTES__] = b
-        return b
+        if self.pristine():
+            return bytes(self[self.__BYTES__])
+
+        b = bytearray(self.size())
+        self.pack_into(b)
+        return bytes(b)
+
+    # How many bytes pack_into() will write, for us and every layer above
+    def size(self):
+        if self.pristine():
+            return len(self[self.__BYTES__])
+        return codec.ETHER.size + self.nextsize()
+
+    # Serialize the whole chain into b at offset o, each layer once and in
+    # place, and return how many bytes that took. Every layer keeps a view of
+    # what it wrote as its bytes, so b mustn't be reused while they're still
+    # in use, nor overlap what they were parsed from.
+    def pack_into(self, b, o=0):
+        if self.pristine():
+            x = self[self.__BYTES__]
+            n = len(x)
+            b[o:o+n] = x
+            return n
+
+        if self.lazy:
+            self.decode()
+
+        codec.ETHER.pack_into(b, o,
+                              self.convert(self.__DST__),
+                              self.convert(self.__SRC__),
+                              self.convert(self.__TYPE__))
+        n = codec.ETHER.size + self.packnext(b, o + codec.ETHER.size)
+
+        self[self.__BYTES__] = memoryview(b)[o:o+n]
+        return n
 
     def moops_keys(self):
         k = self.__KEYS__
@@ -92,46 +184,112 @@ class Ether(dict):
         return x
 
     def getnext(self):
-        if self.__NEXT__ not in self.itemlist:
+        if self.__NEXT__ not in self:
             return b''
         return bytes(self[self.__NEXT__])
 
+    def nextsize(self):
+        if self.__NEXT__ not in self:
+            return 0
+        x = self[self.__NEXT__]
+        if hasattr(x, 'pack_into'):
+            return x.size()
+        if not isinstance(x, (bytes, bytearray, memoryview)):
+            x = bytes(x)
+        return len(x)
+
+    def packnext(self, b, o):
+        if self.__NEXT__ not in self:
+            return 0
+        x = self[self.__NEXT__]
+        if hasattr(x, 'pack_into'):
+            return x.pack_into(b, o)
+        if not isinstance(x, (bytes, bytearray, memoryview)):
+            x = bytes(x)
+        b[o:o+len(x)] = x
+        return len(x)
+
+    # An inbound header that hasn't been modified since it was parsed, and
+    # whose upper layer (if any) is still the one parsed from our own data,
+    # can reuse the received bytes as they are.
+    def pristine(self):
+        if not self.inbound or self.dirty:
+            return False
+
+        if self.__NEXT__ not in self.itemlist:
+            return True
+
+        n = self[self.__NEXT__]
+        if n is self.next():
+            return True
+        if not hasattr(n, 'pristine') or not n.pristine():
+            return False
+        return n.get(self.__BYTES__) is self.next()
+
+    # Our payload as the layer our dispatch table says it holds (see
+    # moops.dispatch), decoded the same way we were and linked both ways. A
+    # payload the table doesn't know is left as it is.
+    def upper(self):
+        if self.dispatch is None:
+            raise KeyError(self.__NEXT__)
+
+        n = self.next()
+        c = self.dispatch.upper(self)
+        if c is not None:
+            n = c({self.__BYTES__: n,
+                   "prev": self,
+                   self.__LAZY__: self.lazy,
+                   self.__NUMERIC__: self.numeric,
+                   self.__DISPATCH__: self.dispatch})
+        dict.__setitem__(self, self.__NEXT__, n)
+        return n
+
     def parse(self):
         if self.__BYTES__ not in self.itemlist:
             self.__bytes__()
 
-        if len(self[self.__BYTES__]) < 14:
+        b = self[self.__BYTES__]
+        if len(b) < codec.ETHER.size:
             raise Exception("Invalid packet length")
 
-        # A temporary store for parsing
-        self[self.__INT_PTR__] = 0
-
-        self.parsemac(self.__DST__)
-        self.parsemac(self.__SRC__)
-        self.parsetype()
+        # Fields that come off the wire go straight into the dict, past
+        # __setitem__, as they don't make us dirty
+        if not self.lazy:
+            d, s, t = codec.ETHER.unpack_from(b)
+            dict.update(self, {
+                self.__DST__: self.parsemac(d),
+                self.__SRC__: self.parsemac(s),
+                self.__TYPE__: t,
+                })
 
         # If we have excess data, try out the next type
-        p = self[self.__INT_PTR__]
-        self[self.__NEXTDATA__] = self[self.__BYTES__][p:]
-
-        # Delete our unneeded key
-        self.pop(self.__INT_PTR__, None)
-
-    def parsemac(self, n):
-        p = self[self.__INT_PTR__]
+        dict.__setitem__(self, self.__NEXTDATA__, b[codec.ETHER.size:])
 
-        s = ''
-        for i in self[self.__BYTES__][p:p+6]:
-            s += "{:02x}:".format(i)
+        # Everything set so far came off the wire
+        self.dirty = False
 
-        self[self.__INT_PTR__] = p + 6
-        self[n] = s[0:-1]
+    # Decode every field a lazy parse hasn't been asked for yet
+    def decode(self):
+        for i in self.__FIELDS__:
+            if i not in self.itemlist:
+                self.get(i)
+
+    def parsefield(self, n):
+        b = self[self.__BYTES__]
+        if n == self.__DST__:
+            return self.parsemac(b[0:6])
+        elif n == self.__SRC__:
+            return self.parsemac(b[6:12])
+        elif n == self.__TYPE__:
+            return codec.SHORT.unpack_from(b, 12)[0]
+        raise KeyError(n)
 
-    def parsetype(self):
-        p = self[self.__INT_PTR__]
-        s = int.from_bytes(self[self.__BYTES__][p:p+2], "big")
-        self['type'] = s
-        self[self.__INT_PTR__] = p + 2
+    # With 'numeric' set, addresses are kept as numbers (see codec.MAC) and
+    # only spelled out if something asks for the text
+    def parsemac(self, b):
+        if self.numeric:
+            return codec.MAC.from_bytes(b, "big")
+        return codec.mac_ntoa(b)
 
     def convert(self, n):
         if n == self.__SRC__ or n == self.__DST__:
@@ -144,17 +302,9 @@ class Ether(dict):
     def convertmac(self, n):
         if n not in self.itemlist:
             return self.__EMPTY__
-
-        b = b''
-        v = self[n]
-        for i in v.split(':'):
-            b += bytes([int(i, 16)])
-
-        return b
+        return codec.mac_aton(self[n])
 
     def converttype(self, n):
         if n not in self.itemlist:
-            return b'\x08\x00'
-
-        x = self[n]
-        return bytes([(x >> 8) & 0xff, x & 0xff])
+            return 0x0800
+        return self[n]
@@ -0,0 +1,36 @@
+import socket
+import struct
+
+
+# PACKET_FANOUT groups. Every AF_PACKET socket bound to the same interface
+# and protocol that joins the same group id gets a share of the traffic
+# instead of a copy of it, split by the group's mode.
+
+SOL_PACKET = getattr(socket, "SOL_PACKET", 263)
+PACKET_FANOUT = 18
+
+MODES = {
+    # By flow hash, so every frame of a flow goes to the same socket
+    "hash": 0,
+    # Round robin
+    "lb": 1,
+    # By the CPU the frame arrived on
+    "cpu": 2,
+    # By receive queue
+    "qm": 5,
+    }
+
+# Reassemble IP fragments before hashing, so they land with their flow
+FLAG_DEFRAG = 0x8000
+
+
+def join(s, group, mode="hash"):
+    if mode not in MODES:
+        raise Exception("Unknown fanout mode: {0}".format(mode))
+
+    m = MODES[mode]
+    if mode == "hash":
+        m |= FLAG_DEFRAG
+    # Packed by hand: with the flag set it doesn't fit a signed int
+    s.setsockopt(SOL_PACKET, PACKET_FANOUT,
+                 struct.pack("I", (group & 0xffff) | (m << 16)))
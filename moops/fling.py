@@ -1,8 +1,22 @@
 import time
 import random
+import select
 import socket
+import threading
+import multiprocessing
 from threading import Thread
 
+from moops import bpf
+from moops import fanout
+from moops import flow
+from moops import memo
+from moops import mmsg
+from moops import pipe
+from moops import ring
+from moops import sampler
+from moops import stats
+from moops.match import Match
+
 
 class Fling(dict, Thread):
     __IN__ = "in"
@@ -12,6 +26,28 @@ class Fling(dict, Thread):
     __MANGLE__ = "mangle"
     __THREADID__ = "threadID"
     __THREADNAME__ = "threadname"
+    __ZEROCOPY__ = "zerocopy"
+    __FILTER__ = "filter"
+    __BATCH__ = "batch"
+    __TIMEOUT__ = "timeout"
+    __RING__ = "ring"
+    __WORKERS__ = "workers"
+    __FANOUT__ = "fanout"
+    __FANOUTMODE__ = "fanoutmode"
+    __PIPELINE__ = "pipeline"
+    __POLICY__ = "policy"
+    __RECORD__ = "record"
+    __FLOWS__ = "flows"
+    __FLOWTTL__ = "flowttl"
+    __RULES__ = "rules"
+    __MEMO__ = "memo"
+    __MEMOKEY__ = "memokey"
+    __STATS__ = "stats"
+    __STATSFILE__ = "statsfile"
+    __STATSSOCK__ = "statssock"
+    __STATSINTERVAL__ = "statsinterval"
+    __PROFILE__ = "profile"
+    __PROFILERATE__ = "profilerate"
 
     __KEYS__ = [
         __IN__,
@@ -19,43 +55,365 @@ class Fling(dict, Thread):
         __NAME__,
         __MATCH__,
         __THREADID__,
-        __THREADNAME__
+        __THREADNAME__,
+        __ZEROCOPY__,
+        __FILTER__,
+        __BATCH__,
+        __TIMEOUT__,
+        __RING__,
+        __WORKERS__,
+        __FANOUT__,
+        __FANOUTMODE__,
+        __PIPELINE__,
+        __POLICY__,
+        __RECORD__,
+        __FLOWS__,
+        __FLOWTTL__,
+        __RULES__,
+        __MEMO__,
+        __MEMOKEY__,
+        __STATS__,
+        __STATSFILE__,
+        __STATSSOCK__,
+        __STATSINTERVAL__,
+        __PROFILE__,
+        __PROFILERATE__
+        ]
+
+    # Counters, see process(). A frame that matched but wasn't sent, as the
+    # mangle gave nothing back (or there was no mangle), is dropped.
+    __RECEIVED__ = "received"
+    __MATCHED__ = "matched"
+    __MANGLED__ = "mangled"
+    __DROPPED__ = "dropped"
+    __SENT__ = "sent"
+
+    __COUNTERS__ = [
+        __RECEIVED__,
+        __MATCHED__,
+        __MANGLED__,
+        __DROPPED__,
+        __SENT__
         ]
 
+    # Stages timed with 'stats' set, see timed()
+    __RECV__ = "recv"
+    __SEND__ = "send"
+
+    __STAGES__ = [
+        __RECV__,
+        __MATCH__,
+        __MANGLE__,
+        __SEND__
+        ]
+
+    __BUFSIZE__ = 65536
+
+    # How long a batched frame may wait for its batch to fill up, in seconds
+    __FLUSH__ = 0.001
+
+    # How often a blocked batch loop wakes up to check do_exit, in seconds
+    __POLL__ = 1.0
+
+    # How often a worker process publishes its counters, in seconds
+    __PUBLISH__ = 0.1
+
+    # How long a flow may go without a frame before it's forgotten, in
+    # seconds
+    __FLOWTTL_DEFAULT__ = 30.0
+
+    # How often a snapshot is dumped, in seconds
+    __STATSINTERVAL_DEFAULT__ = 1.0
+
+    # How often the profiler samples, per second. Not a round number, so as
+    # not to keep step with anything that happens every so many ms.
+    __PROFILERATE_DEFAULT__ = 99
+
     _in = None
     _out = None
+    _buf = None
+    queues = None
+    flows = None
+    memo = None
+    timings = None
+    dump = None
+    profiler = None
     itemlist = None
+    counters = None
     do_exit = False
 
     def __init__(self, *args, **kw):
         dict.__init__(self, *args, **kw)
         Thread.__init__(self)
 
+        self.counters = dict((k, 0) for k in self.__COUNTERS__)
+
         if self.itemlist and self.__THREADID__ in self.itemlist:
             self.threadID = self[self.__THREADID__]
         if self.itemlist and self.__THREADNAME__ in self.itemlist:
             self.name = self[self.__THREADNAME__]
 
         self.itemlist = super(Fling, self).keys()
+
+        if self.get(self.__FLOWS__):
+            self.flows = flow.Table(int(self[self.__FLOWS__]),
+                                    self.get(self.__FLOWTTL__,
+                                             self.__FLOWTTL_DEFAULT__))
+
+        if self.get(self.__MEMO__):
+            self.memo = memo.Memo(None, int(self[self.__MEMO__]),
+                                  self.get(self.__MEMOKEY__))
+
+        if self.get(self.__STATS__):
+            self.timings = dict((k, stats.Histogram())
+                                for k in self.__STAGES__)
+
+        # One writer can't be shared across forked workers: each would flush
+        # its own copy of the buffer into the same file
+        if self.get(self.__WORKERS__) and self.__RECORD__ in self.itemlist:
+            raise Exception("Fling: 'record' can't be used with 'workers'")
+
         self.bootstrap()
 
+    # Thread keeps us in a set, and two Flings may well be configured alike
+    # (e.g. with equal Mangle objects), so hash by identity rather than by
+    # contents
     def __hash__(self):
-        return hash(tuple(sorted(self.items())))
+        return id(self)
 
     def bootstrap(self):
         if ((self.__IN__ not in self.itemlist) or
                 (self.__OUT__ not in self.itemlist)):
                 return
 
+        # The worker processes open their own sockets
+        if self.get(self.__WORKERS__):
+            return
+
         s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(0x0800))
         s.bind((self[self.__IN__], 0))
+        if self.__FANOUT__ in self.itemlist:
+            fanout.join(s, self[self.__FANOUT__],
+                        self.get(self.__FANOUTMODE__, "hash"))
         self._in = s
 
         s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
         r = s.bind((self[self.__OUT__], 0))
         self._out = s
 
+    # Compile the match into a socket filter, so frames that can't match are
+    # dropped in the kernel instead of being copied up to us. Set 'filter' to
+    # False to receive everything.
+    def attach(self):
+        if not self._in or self.__MATCH__ not in self.itemlist:
+            return
+        if not self.get(self.__FILTER__, True):
+            return
+
+        m = self[self.__MATCH__]
+        if not isinstance(m, Match):
+            return
+
+        p = bpf.program(m)
+        if p is None:
+            return
+        bpf.attach(self._in, p)
+
+        # Anything queued before the filter went on hasn't been through it
+        self._in.setblocking(False)
+        try:
+            while True:
+                self._in.recv(self.__BUFSIZE__)
+        except BlockingIOError:
+            pass
+        self._in.setblocking(True)
+
+    def recv(self):
+        if not self.get(self.__ZEROCOPY__):
+            return self._in.recvfrom(self.__BUFSIZE__)[0]
+
+        # Every frame lands in the same buffer and is handed on as a view
+        # into it, so it's only copied once a layer is actually modified.
+        if self._buf is None:
+            self._buf = memoryview(bytearray(self.__BUFSIZE__))
+        n = self._in.recv_into(self._buf)
+        return self._buf[:n]
+
+    # Match and mangle one frame. Returns the frame to send, if any.
+    #
+    # With 'rules' (a RuleSet, see moops/rules.py) in place of 'match', the
+    # frame gets the mangle of the first rule it matches, or 'mangle' if
+    # that rule has none.
+    #
+    # With 'flows' set, a table of up to that many flows is kept (see
+    # moops/flow.py), and only the first frame of each flow is matched; the
+    # rest get the same verdict. That's only right for a match that looks at
+    # nothing but fields every frame of a flow has in common. A Mangle that
+    # says it's 'planned' works out a plan on the first frame too, and the
+    # rest of the flow is patched by it.
+    #
+    # With 'memo' set, up to that many outputs of the mangle are kept (see
+    # moops/memo.py), keyed on the whole frame or on the 'memokey' fields,
+    # and a frame seen before gets its output back without being mangled
+    # again. That's only right for a mangle that always makes the same
+    # frame out of the same input.
+    def process(self, x):
+        c = self.counters
+        c[self.__RECEIVED__] += 1
+
+        if (self.__MATCH__ not in self.itemlist and
+                self.__RULES__ not in self.itemlist):
+            return None
+
+        v, e = self.timed(self.__MATCH__, self.classify, x)
+        if not v:
+            return None
+        c[self.__MATCHED__] += 1
+
+        # A rule's own mangle, if it has one
+        m = None
+        if v is not True:
+            m = v[2]
+        if m is None:
+            m = self.get(self.__MANGLE__)
+        if m is None:
+            print("Fling: nothing to mangle")
+            c[self.__DROPPED__] += 1
+            return None
+
+        # Mangle and update the packet
+        x = self.timed(self.__MANGLE__, self.transform, m, x, e)
+        if x is None:
+            c[self.__DROPPED__] += 1
+            return None
+        c[self.__MANGLED__] += 1
+
+        # Keep a copy of what goes out, e.g. in a pcap.Writer
+        if self.__RECORD__ in self.itemlist:
+            self[self.__RECORD__].write(x)
+        return x
+
+    # The verdict on frame x, and its flow table entry (if any)
+    def classify(self, x):
+        if self.flows is None:
+            return self.verdict(x), None
+
+        k = self.flows.key(x)
+        e = self.flows.get(k)
+        if e is None:
+            e = self.flows.add(k, self.verdict(x))
+        return e[flow.VERDICT], e
+
+    # Frame x mangled by m, by x's flow plan or out of the memo if possible
+    def transform(self, m, x, e):
+        if e is not None and getattr(m, "planned", False):
+            if e[flow.PLAN] is flow.UNPLANNED:
+                e[flow.PLAN], y = m.plan(x)
+                return y
+            if e[flow.PLAN]:
+                return m.apply(x, e[flow.PLAN])
+        if self.memo is not None:
+            return self.memo.call(m, x)
+        return m(x)
+
+    # True or False for 'match'; for 'rules', the rule matched, or None
+    def verdict(self, x):
+        if self.__RULES__ in self.itemlist:
+            return self[self.__RULES__].lookup(x)
+        return self[self.__MATCH__] == x
+
+    # Call f(*args) for stage k, and time it if 'stats' is set. Each stage
+    # is only ever timed from one thread, so no histogram needs a lock.
+    def timed(self, k, f, *args):
+        if self.timings is None:
+            return f(*args)
+        t = time.perf_counter_ns()
+        r = f(*args)
+        self.timings[k].record(time.perf_counter_ns() - t)
+        return r
+
+    # Everything there is to know about how we're doing: the counters, each
+    # stage's latency in nanoseconds (with 'stats' set), and the flow table,
+    # memo and pipeline queues, where they're in use
+    def snapshot(self):
+        s = {
+            "name": self.get(self.__NAME__, self.name),
+            "time": time.time(),
+            "counters": dict(self.counters),
+            }
+        if self.timings is not None:
+            s["latency"] = dict((k, h.snapshot())
+                                for k, h in self.timings.items())
+        if self.flows is not None:
+            s["flows"] = self.flowstats()
+        if self.memo is not None:
+            s["memo"] = self.memostats()
+        if self.queues:
+            s["queues"] = self.depths()
+        if self.profiler is not None:
+            s["profile"] = self.profiler.stats()
+        return s
+
+    # Dump a snapshot to 'statsfile' and/or 'statssock' every
+    # 'statsinterval' seconds, for as long as we run
+    def report(self):
+        f = self.get(self.__STATSFILE__)
+        u = self.get(self.__STATSSOCK__)
+        if f is None and u is None:
+            return
+        self.dump = stats.Dump(self.snapshot, f, u,
+                               self.get(self.__STATSINTERVAL__,
+                                        self.__STATSINTERVAL_DEFAULT__))
+        self.dump.start()
+
+    # Sample this thread's stack 'profilerate' times a second, and write
+    # where it spent its time to 'profile' as collapsed stacks. A supervisor
+    # of workers leaves it to them, as they do the work.
+    def profile(self):
+        p = self.get(self.__PROFILE__)
+        if p is None or self.get(self.__WORKERS__):
+            return
+        self.profiler = sampler.Sampler(threading.get_ident(), p,
+                                        self.get(self.__PROFILERATE__,
+                                                 self.__PROFILERATE_DEFAULT__))
+        self.profiler.start()
+
     def run(self):
+        self.report()
+        self.profile()
+        try:
+            self.serve()
+        finally:
+            # Whatever's still buffered for 'record' would be lost
+            r = self.get(self.__RECORD__)
+            if r is not None and hasattr(r, "flush"):
+                r.flush()
+            if self.profiler is not None:
+                self.profiler.join()
+                self.profiler.write()
+            if self.dump is not None:
+                self.dump.join()
+                self.dump.dump()
+
+    def serve(self):
+        if self.get(self.__WORKERS__):
+            self.run_workers()
+            return
+
+        self.attach()
+
+        if self.get(self.__PIPELINE__):
+            self.run_pipeline()
+            return
+
+        if self.get(self.__RING__):
+            self.run_ring()
+            return
+
+        if self.get(self.__BATCH__):
+            self.run_batch()
+            return
+
         while True:
             if self.do_exit:
                 break
@@ -65,18 +423,280 @@ class Fling(dict, Thread):
                 time.sleep(3)
                 continue
 
-            x = self._in.recvfrom(65536)
-            if self.__MATCH__ in self.itemlist:
-                if not self[self.__MATCH__] == x[0]:
+            x = self.process(self.timed(self.__RECV__, self.recv))
+            if x is not None:
+                self.timed(self.__SEND__, self._out.send, x)
+                self.counters[self.__SENT__] += 1
+
+    # Like run(), but up to 'batch' frames are taken in per recvmmsg() call,
+    # and sent out per sendmmsg() call. A frame waits at most 'timeout'
+    # seconds for its outgoing batch to fill before it's flushed anyway.
+    def run_batch(self):
+        while not self._in or not self._out:
+            if self.do_exit:
+                return
+            print("No interfaces, yet.")
+            time.sleep(3)
+
+        n = int(self[self.__BATCH__])
+        t = self.get(self.__TIMEOUT__, self.__FLUSH__)
+        rx = mmsg.Batch(self._in, n)
+        tx = mmsg.Batch(self._out, n)
+        c = self.counters
+        first = 0
+
+        while not self.do_exit:
+            w = self.__POLL__
+            if len(tx):
+                w = max(0, first + t - time.monotonic())
+
+            r = select.select([self._in], [], [], w)[0]
+            if r:
+                for x in self.timed(self.__RECV__, rx.recv):
+                    x = self.process(x)
+                    if x is None:
+                        continue
+
+                    if not len(tx):
+                        first = time.monotonic()
+                    tx.put(x)
+                    if tx.full():
+                        c[self.__SENT__] += self.timed(self.__SEND__, tx.flush)
+
+            if len(tx) and time.monotonic() - first >= t:
+                c[self.__SENT__] += self.timed(self.__SEND__, tx.flush)
+
+        c[self.__SENT__] += self.timed(self.__SEND__, tx.flush)
+
+    # Like run(), but frames come in through a PACKET_MMAP receive ring and
+    # go out through a transmit ring (see moops/ring.py). Match and Mangle
+    # see each frame as a view straight into the receive ring, and its block
+    # goes back to the kernel once every frame in it has been processed.
+    # Whatever a block produced is sent with one kick of the transmit ring.
+    def run_ring(self):
+        while not self._in or not self._out:
+            if self.do_exit:
+                return
+            print("No interfaces, yet.")
+            time.sleep(3)
+
+        rx = ring.RxRing(self._in)
+        tx = ring.TxRing(self._out)
+        c = self.counters
+
+        try:
+            while not self.do_exit:
+                b = rx.wait(self.__POLL__)
+                if b is None:
                     continue
 
-                if self.__MANGLE__ not in self.itemlist:
-                    print("Fling: nothing to mangle")
+                for x in rx.frames(b):
+                    x = self.process(x)
+                    if x is not None:
+                        tx.put(x)
+                rx.release(b)
+
+                c[self.__SENT__] += self.timed(self.__SEND__, tx.flush)
+        finally:
+            c[self.__SENT__] += self.timed(self.__SEND__, tx.flush)
+
+            # The rings' sockets are no good for anything else now
+            rx.close()
+            tx.close()
+            self._in.close()
+            self._out.close()
+
+    # Run 'workers' copies of this Fling, each in its own process with its
+    # own sockets. Their input sockets all join one PACKET_FANOUT group, so
+    # the kernel splits the traffic between them ('fanoutmode' picks how:
+    # "hash" keeps each flow on one worker, "cpu" keeps each frame on the
+    # CPU it arrived on). This thread supervises: it restarts any worker
+    # that dies, and keeps self.counters the sum of every worker's.
+    def run_workers(self):
+        ctx = multiprocessing.get_context("fork")
+        n = int(self[self.__WORKERS__])
+
+        if self.__RECORD__ in self.itemlist:
+            raise Exception("Fling: 'record' can't be used with 'workers'")
+
+        # Only we report, with every worker's counters summed
+        cfg = dict(self)
+        del cfg[self.__WORKERS__]
+        cfg.pop(self.__STATSFILE__, None)
+        cfg.pop(self.__STATSSOCK__, None)
+        cfg[self.__FANOUT__] = self.get(self.__FANOUT__,
+                                        random.getrandbits(16))
+
+        stop = ctx.Event()
+        workers = [None] * n
+        shared = [None] * n
+        started = [0] * n
+
+        # Counts from workers that died and were replaced
+        base = dict((k, 0) for k in self.__COUNTERS__)
+
+        try:
+            while not self.do_exit:
+                for i in range(n):
+                    if workers[i] is not None and workers[i].is_alive():
+                        continue
+
+                    # Don't spin on a worker that dies as soon as it starts
+                    if time.monotonic() - started[i] < self.__POLL__:
+                        continue
+
+                    if workers[i] is not None:
+                        print("Fling: worker {0} exited ({1}), "
+                              "restarting".format(i, workers[i].exitcode))
+                        for j, k in enumerate(self.__COUNTERS__):
+                            base[k] += shared[i][j]
+
+                    shared[i] = ctx.Array('Q', len(self.__COUNTERS__),
+                                          lock=False)
+                    workers[i] = ctx.Process(target=self.worker,
+                                             args=(self.workercfg(cfg, i),
+                                                   shared[i], stop),
+                                             daemon=True)
+                    workers[i].start()
+                    started[i] = time.monotonic()
+
+                self.merge(base, shared)
+                time.sleep(self.__PUBLISH__)
+        finally:
+            stop.set()
+            for p in workers:
+                if p is None:
                     continue
+                p.join(self.__POLL__)
+                if p.is_alive():
+                    p.terminate()
+                    p.join()
+            self.merge(base, shared)
+
+    def merge(self, base, shared):
+        c = dict(base)
+        for a in shared:
+            if a is None:
+                continue
+            for j, k in enumerate(self.__COUNTERS__):
+                c[k] += a[j]
+        self.counters = c
+
+    # Worker i's cfg. Each profiles itself into a file of its own, 'profile'
+    # with its number on the end.
+    def workercfg(self, cfg, i):
+        if self.__PROFILE__ not in cfg:
+            return cfg
+        cfg = dict(cfg)
+        cfg[self.__PROFILE__] = "{0}.{1}".format(cfg[self.__PROFILE__], i)
+        return cfg
+
+    # The body of a worker process: run a Fling on cfg and publish its
+    # counters into shared until told to stop. The Fling thread may be
+    # blocked in recv(), so it's a daemon and simply goes with the process.
+    def worker(self, cfg, shared, stop):
+        f = Fling(cfg)
+        f.daemon = True
+        f.start()
+
+        while not stop.wait(self.__PUBLISH__) and f.is_alive():
+            self.publish(f, shared)
+
+        f.join()
+        self.publish(f, shared)
+
+    def publish(self, f, shared):
+        for j, k in enumerate(self.__COUNTERS__):
+            shared[j] = f.counters[k]
+
+    # Like run(), but receiving, processing and sending are separate stages,
+    # each on its own thread, joined by bounded queues of 'pipeline' frames.
+    # A slow mangle or a busy output then no longer holds up draining the
+    # input socket. 'policy' says what a stage does when the queue after it
+    # is full: "drop" the frame (the default), or "block" until there's
+    # room. See depths() for where frames are piling up.
+    def run_pipeline(self):
+        while not self._in or not self._out:
+            if self.do_exit:
+                return
+            print("No interfaces, yet.")
+            time.sleep(3)
+
+        n = int(self[self.__PIPELINE__])
+        policy = self.get(self.__POLICY__, pipe.DROP)
+        self.queues = {
+            "rx": pipe.Queue(n, policy),
+            "tx": pipe.Queue(n, policy),
+            }
+
+        stages = [
+            Thread(target=self.stage_rx, daemon=True),
+            Thread(target=self.stage_tx, daemon=True),
+            ]
+        for t in stages:
+            t.start()
+
+        rx = self.queues["rx"]
+        tx = self.queues["tx"]
+        while not self.do_exit:
+            x = rx.get(self.__POLL__)
+            if x is None:
+                continue
+
+            x = self.process(x)
+            if x is not None:
+                while not tx.put(x, self.__POLL__) and not self.do_exit:
+                    if tx.policy == pipe.DROP:
+                        break
+
+        for t in stages:
+            Thread.join(t)
+
+    # Every frame is a copy of its own, since it's held in a queue
+    def stage_rx(self):
+        q = self.queues["rx"]
+        while not self.do_exit:
+            if not select.select([self._in], [], [], self.__POLL__)[0]:
+                continue
+
+            x = self.timed(self.__RECV__, self._in.recvfrom,
+                           self.__BUFSIZE__)[0]
+            while not q.put(x, self.__POLL__) and not self.do_exit:
+                if q.policy == pipe.DROP:
+                    break
+
+    def stage_tx(self):
+        q = self.queues["tx"]
+        while not self.do_exit:
+            x = q.get(self.__POLL__)
+            if x is None:
+                continue
+            self.timed(self.__SEND__, self._out.send, x)
+            self.counters[self.__SENT__] += 1
+
+    # The size and hit rate of the flow table
+    def flowstats(self):
+        if self.flows is None:
+            return {}
+        return self.flows.stats()
+
+    # The size and hit rate of the mangle's memo
+    def memostats(self):
+        if self.memo is None:
+            return {}
+        return self.memo.stats()
 
-                # Mangle and update the packet
-                x = self[self.__MANGLE__](x[0])
-                self._out.send(x)
+    # The depth, high water mark, size and drop count of each stage's input
+    # queue
+    def depths(self):
+        if not self.queues:
+            return {}
+        return dict((k, q.stats()) for k, q in self.queues.items())
 
+    # We may be blocked in recv() for good, and never get to write our
+    # profile ourselves, so it's written here too
     def join(self):
         self.do_exit = True
+        if self.profiler is not None:
+            self.profiler.join()
+            self.profiler.write()
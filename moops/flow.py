@@ -0,0 +1,136 @@
+import time
+import struct
+from collections import OrderedDict
+
+from moops import codec
+
+
+# A table of the flows a Fling has seen, keyed on their 5-tuple (source and
+# destination address, protocol, source and destination port), so that what
+# was decided for a flow's first frame can be reused for the rest of it
+# without matching them again.
+#
+# Entries are kept in the order they were last used. That makes the oldest
+# one both the least recently used, to evict when the table is full, and the
+# longest idle, so expiring idle flows never has to look past the first entry
+# that's still live.
+
+# vhl, flags/offset, protocol, src, dst, from the start of the IP header
+HEADER = struct.Struct("!B5xHxB2x4s4s")
+
+# src and dst ports, at the start of the transport header
+PORTS = struct.Struct("!HH")
+
+# Protocols whose header starts with the ports
+PORTED = (6, 17)
+
+# What an entry holds, by index
+VERDICT = 0
+PLAN = 1
+SEEN = 2
+PACKETS = 3
+
+# A plan that hasn't been worked out yet, as opposed to None for none at all
+UNPLANNED = False
+
+
+class Table:
+    def __init__(self, size=65536, ttl=30.0):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # The 5-tuple of frame x, or None if it isn't IPv4. Fragments past the
+    # first carry no ports, and have zeroes in their place.
+    def key(self, x):
+        try:
+            if codec.SHORT.unpack_from(x, 12)[0] != 0x0800:
+                return None
+            vhl, foff, p, s, d = HEADER.unpack_from(x, 14)
+
+            sport = dport = 0
+            if p in PORTED and not foff & 0x1fff:
+                sport, dport = PORTS.unpack_from(x, 14 + (vhl & 0x0f) * 4)
+        except struct.error:
+            return None
+        return (s, d, p, sport, dport)
+
+    # The live entry for flow k, if there is one
+    def get(self, k, now=None):
+        if k is None:
+            return None
+
+        e = self.entries.get(k)
+        if e is None:
+            self.misses += 1
+            return None
+
+        if now is None:
+            now = time.monotonic()
+        if now - e[SEEN] > self.ttl:
+            del self.entries[k]
+            self.expired += 1
+            self.misses += 1
+            return None
+
+        e[SEEN] = now
+        e[PACKETS] += 1
+        self.entries.move_to_end(k)
+        self.hits += 1
+        return e
+
+    # Start a new entry for flow k. It's returned, but only kept if k is a
+    # flow at all.
+    def add(self, k, verdict, plan=UNPLANNED, now=None):
+        if now is None:
+            now = time.monotonic()
+        e = [verdict, plan, now, 1]
+        if k is None:
+            return e
+
+        self.expire(now)
+        while len(self.entries) >= self.size:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+        self.entries[k] = e
+        return e
+
+    # Drop every flow that's been idle for longer than ttl
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        d = self.entries
+        while d:
+            e = d[next(iter(d))]
+            if now - e[SEEN] <= self.ttl:
+                break
+            d.popitem(last=False)
+            self.expired += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    # How full the table is, and how often a frame's flow was found in it
+    def stats(self):
+        n = self.hits + self.misses
+        r = 0
+        if n:
+            r = self.hits / n
+        return {
+            "size": len(self.entries),
+            "capacity": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitrate": r,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            }
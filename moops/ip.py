@@ -1,5 +1,8 @@
 import socket
 
+from moops import codec
+from moops import checksum
+
 
 class IP(dict):
     # Our dictionary, so it's easy to access
@@ -21,12 +24,13 @@ class IP(dict):
 
     # Not "exported"; internal use only
     __BYTES__ = "bytes"
-    __INT_PTR__ = "__ptr"
     __INT_OPTIONS__ = "__options"
     __LOCALHOST__ = "127.0.0.1"
-    __INT_FOFF__ = "__foff"
     __DEFAULT_TTL__ = 128
     __NEXTDATA__ = "__next"
+    __LAZY__ = "lazy"
+    __NUMERIC__ = "numeric"
+    __DISPATCH__ = "dispatch"
 
     __KEYS__ = [
         __VERSION__,
@@ -50,69 +54,178 @@ class IP(dict):
         __NEXT__,
         __NAME__,
         __BYTES__,
-        __NEXTDATA__
+        __NEXTDATA__,
+        __LAZY__,
+        __NUMERIC__,
+        __DISPATCH__
+        ]
+
+    # Header fields, as opposed to bookkeeping keys
+    __FIELDS__ = [
+        __VERSION__,
+        __IHL__,
+        __TOS__,
+        __LENGTH__,
+        __IDENT__,
+        __FLAGS__,
+        __OFFSET__,
+        __TTL__,
+        __PROTOCOL__,
+        __CHECKSUM__,
+        __SRC__,
+        __DST__,
+        __OPTIONS__
         ]
 
     __EMPTY__ = bytes(6)
 
     itemlist = None
     inbound = False
+    dirty = False
+    lazy = False
+    numeric = False
+    dispatch = None
 
     def __init__(self, *args, **kw):
         dict.__init__(self, *args, **kw)
         self.itemlist = super(IP, self).keys()
-        self[self.__NAME__] = "IP"
+        dict.__setitem__(self, self.__NAME__, "IP")
 
         # Auto-parse if we have bytes
         if self.__BYTES__ in self.itemlist:
             self.inbound = True
+            self.lazy = bool(dict.get(self, self.__LAZY__))
+            self.numeric = bool(dict.get(self, self.__NUMERIC__))
+            self.dispatch = dict.get(self, self.__DISPATCH__)
             self.parse()
 
+    # Track whether a parsed header has been touched, so an untouched one can
+    # be handed back without being rebuilt
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, v)
+        if k in self.__FIELDS__:
+            self.dirty = True
+            if codec.ASSIGNED.log is not None:
+                codec.ASSIGNED.log.append((self, k))
+
+    # In lazy mode a field is only decoded from the received bytes the first
+    # time it's read, and then cached like any other key. So is the upper
+    # layer, when we were parsed through a dispatch table.
+    def __missing__(self, k):
+        if k == self.__NEXT__:
+            return self.upper()
+        if not self.lazy or k not in self.__FIELDS__:
+            raise KeyError(k)
+        v = self.parsefield(k)
+        dict.__setitem__(self, k, v)
+        return v
+
+    def __contains__(self, k):
+        if dict.__contains__(self, k):
+            return True
+        if k == self.__NEXT__:
+            if self.dispatch is None:
+                return False
+        elif not self.lazy or k not in self.__FIELDS__:
+            return False
+        try:
+            self[k]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, k, d=None):
+        if k in self:
+            return self[k]
+        return d
+
     def __hash__(self):
         return hash(tuple(sorted(self.items())))
 
     def __eq__(self, x):
-        ip = IP({self.__BYTES__: x})
-        ip.parse()
+        # Only the fields we compare against get decoded, and addresses are
+        # compared as numbers
+        ip = IP({self.__BYTES__: x, self.__LAZY__: True,
+                 self.__NUMERIC__: True})
         for i in self.itemlist:
             if i in self.__SKIP__:
                 continue
             if i not in ip or self[i] != ip[i]:
                 return False
 
-            if self.__NEXT__ in self.itemlist:
-                return self[self.__NEXT__] == ip.next()
+        if self.__NEXT__ in self.itemlist:
+            return self[self.__NEXT__] == ip.next()
 
         return True
 
     def __bytes__(self):
+        if self.pristine():
+            return bytes(self[self.__BYTES__])
+
+        b = bytearray(self.size())
+        self.pack_into(b)
+        return bytes(b)
+
+    # How many bytes pack_into() will write, for us and every layer above
+    def size(self):
+        if self.pristine():
+            return len(self[self.__BYTES__])
+
+        if self.lazy:
+            self.decode()
+
+        # The length may pad the payload
+        self.generate_options()
+        self.update_ihl()
+        self.convert_vhl()
+        self.convert_length()
+        return codec.IP.size + len(self.convert_options()) + self.nextsize()
+
+    # Serialize the whole chain into b at offset o (see Ether.pack_into())
+    def pack_into(self, b, o=0):
+        if self.pristine():
+            x = self[self.__BYTES__]
+            n = len(x)
+            b[o:o+n] = x
+            return n
+
+        if self.lazy:
+            self.decode()
+
         # First, so we know the packet size, do the following
         self.generate_options()
         self.update_ihl()
 
-        # Now, generate the summable header
-        b = b''
-        b += self.convert_vhl()
-        b += self.convert_tos()
-        b += self.convert_length()
-        b += self.convert_ident()
-        b += self.convert_flags()
-        b += self.convert_ttl()
-        b += self.convert_protocol()
-        b += b'\x00\x00'
-        b += self.convert_src()
-        b += self.convert_dst()
-        b += self.convert_options()
+        # The length must be known before the payload is written, as it may
+        # pad the payload. The payload goes in first, so the header is
+        # written once, around it.
+        v = self.convert_vhl()
+        l = self.convert_length()
+        x = self.convert_options()
+        h = codec.IP.size + len(x)
+        n = self.packnext(b, o + h)
+
+        codec.IP.pack_into(b, o,
+                           v,
+                           self.convert_tos(),
+                           l,
+                           self.convert_ident(),
+                           self.convert_flags(),
+                           self.convert_ttl(),
+                           self.convert_protocol(),
+                           0,
+                           self.convert_src(),
+                           self.convert_dst())
+        b[o + codec.IP.size:o + h] = x
 
         # Now, generate the checksum if desired
-        c = self.convert_checksum(b)
-        b = b[0:10] + bytes([((c >> 8) & 0xff), (c & 0xff)]) + b[12:]
-
-        b += self.getnext()
+        m = memoryview(b)
+        c = self.convert_checksum(m[o:o+h])
+        codec.SHORT.pack_into(b, o + 10, c & 0xffff)
 
         # Ready!
-        self[self.__BYTES__] = b
-        return b
+        self[self.__BYTES__] = m[o:o+h+n]
+        return h + n
 
     # This represent the keys that alter the behavior of the module
     def moops_keys(self):
@@ -131,20 +244,55 @@ class IP(dict):
         return x
 
     def getnext(self):
-        if self.__NEXT__ not in self.itemlist:
+        if self.__NEXT__ not in self:
             return b''
         return bytes(self[self.__NEXT__])
 
+    def nextsize(self):
+        if self.__NEXT__ not in self:
+            return 0
+        x = self[self.__NEXT__]
+        if hasattr(x, 'pack_into'):
+            return x.size()
+        if not isinstance(x, (bytes, bytearray, memoryview)):
+            x = bytes(x)
+        return len(x)
+
+    def packnext(self, b, o):
+        if self.__NEXT__ not in self:
+            return 0
+        x = self[self.__NEXT__]
+        if hasattr(x, 'pack_into'):
+            return x.pack_into(b, o)
+        if not isinstance(x, (bytes, bytearray, memoryview)):
+            x = bytes(x)
+        b[o:o+len(x)] = x
+        return len(x)
+
+    # An inbound header that hasn't been modified since it was parsed, and
+    # whose upper layer (if any) is still the one parsed from our own data,
+    # can reuse the received bytes as they are.
+    def pristine(self):
+        if not self.inbound or self.dirty:
+            return False
+
+        if self.__NEXT__ not in self.itemlist:
+            return True
+
+        n = self[self.__NEXT__]
+        if n is self.next():
+            return True
+        if not hasattr(n, 'pristine') or not n.pristine():
+            return False
+        return n.get(self.__BYTES__) is self.next()
+
+    # Sized without serializing the payload
     def get_datalength(self):
-        l = 0
-        if self.__NEXT__ in self.itemlist:
-            p = self[self.__NEXT__]
-            l = len(bytes(p))
-        return l
+        return self.nextsize()
 
     def pad_data(self, n):
         # This presumes that the Next module can handle a byte add
-        if self.__NEXT__ in self.itemlist:
+        if self.__NEXT__ in self:
             p = self[self.__NEXT__]
             p += bytes(n)
             self[self.__NEXT__] = p
@@ -170,40 +318,24 @@ class IP(dict):
         a = self.__LOCALHOST__
         if self.__SRC__ in self.itemlist:
             a = self[self.__SRC__]
-        return socket.inet_aton(a)
+        return codec.ip_aton(a)
 
     def convert_dst(self):
         a = self.__LOCALHOST__
         if self.__DST__ in self.itemlist:
             a = self[self.__DST__]
-        return socket.inet_aton(a)
+        return codec.ip_aton(a)
 
     def generate_checksum(self, b):
-        s = 0
-        i = 0
-        c = len(b)
-        while c > 1:
-            s += int.from_bytes(b[i:i+2], "big")
-            i += 2
-            c -= 2
-
-        if c > 0:
-            s += int.from_bytes(b[i], "big")
-
-        while (s >> 16) != 0:
-            s = (s & 0xffff) + (s >> 16)
-
-        return ~s
+        return checksum.compute(b)
 
     # Generate a pseudo header for TCP or UDP
     def pseudoheader(self, l):
-        b = b''
-        b += self.convert_src()
-        b += self.convert_dst()
-        b += b'\x00'
-        b += self.convert_protocol()
-        b += bytes([(l >> 8) & 0xff, (l & 0xff)])
-        return b
+        return codec.PSEUDO.pack(self.convert_src(),
+                                 self.convert_dst(),
+                                 0,
+                                 self.convert_protocol(),
+                                 l)
 
     def update_ihl(self):
         # First, see if we have any options
@@ -241,7 +373,7 @@ class IP(dict):
         if l < 0 or l > 15:
             raise Exception("Invalid ihl")
 
-        return bytes([(v << 4) | (l)])
+        return (v << 4) | l
 
     def convert_tos(self):
         t = 0
@@ -251,7 +383,7 @@ class IP(dict):
         if t < 0 or t > 255:
             raise Exception("Invalid TOS")
 
-        return bytes([t])
+        return t
 
     def convert_length(self):
         x = 0
@@ -269,14 +401,14 @@ class IP(dict):
         else:
             x = self[self.__LENGTH__]
 
-        return bytes([((x >> 8) & 0xff), (x & 0xff)])
+        return x
 
     def convert_ident(self):
         x = 0
         if self.__IDENT__ in self.itemlist:
             x = self[self.__IDENT__]
 
-        return bytes([((x >> 8) & 0xff), (x & 0xff)])
+        return x
 
     # This consists of both Flags and Fragment Offset
     def convert_flags(self):
@@ -287,115 +419,160 @@ class IP(dict):
         if self.__OFFSET__ in self.itemlist:
             o = self[self.__OFFSET__]
 
-        x = ((f & 0x07) << 13) | o
-
-        return bytes([((x >> 8) & 0xff), (x & 0xff)])
+        return ((f & 0x07) << 13) | o
 
     def convert_ttl(self):
         t = self.__DEFAULT_TTL__
         if self.__TTL__ in self.itemlist:
             t = self[self.__TTL__]
-        return bytes([t])
+        return t
 
     def convert_protocol(self):
         # UDP by default
         x = 17
         if self.__PROTOCOL__ in self.itemlist:
             x = self[self.__PROTOCOL__]
-        return bytes([x])
+        return x
 
     def convert_checksum(self, b):
         c = 0
-        if self.__CHECKSUM__ not in self.itemlist or self.inbound:
+        if self.inbound:
+            c = self.update_checksum(b)
+        elif self.__CHECKSUM__ not in self.itemlist:
             c = self.generate_checksum(b)
         else:
             c = self[self.__CHECKSUM__]
         return c
 
+    # A header we parsed (or last built) already carries a checksum for what
+    # it held, so patch in just the words that changed since (RFC 1624)
+    # instead of summing the whole header again.
+    def update_checksum(self, b):
+        o = self[self.__BYTES__]
+        h = len(b)
+        if len(o) < h or (o[0] & 0x0f) * 4 != h:
+            return self.generate_checksum(b)
+
+        c = codec.SHORT.unpack_from(o, 10)[0]
+        c = checksum.update(c, o[0:10], b[0:10])
+        return checksum.update(c, o[12:h], b[12:h])
+
+    # Our payload as the layer our dispatch table says it holds (see
+    # moops.dispatch), decoded the same way we were and linked both ways. A
+    # payload the table doesn't know is left as it is.
+    def upper(self):
+        if self.dispatch is None:
+            raise KeyError(self.__NEXT__)
+
+        n = self.next()
+        c = self.dispatch.upper(self)
+        if c is not None:
+            n = c({self.__BYTES__: n,
+                   "prev": self,
+                   self.__LAZY__: self.lazy,
+                   self.__NUMERIC__: self.numeric,
+                   self.__DISPATCH__: self.dispatch})
+        dict.__setitem__(self, self.__NEXT__, n)
+        return n
+
     def parse(self):
         if self.__BYTES__ not in self.itemlist:
             self.__bytes__()
 
         # While we can theoretically send an invalid or short packet, there is
         # little value in parsing a packet that isn't full (some exceptions)
-        if len(self[self.__BYTES__]) < 20:
+        b = self[self.__BYTES__]
+        if len(b) < codec.IP.size:
             raise Exception("Invalid packet length")
 
-        self[self.__INT_PTR__] = 0
-
-        self.parsevhl()
-        self.parsebyte(self.__TOS__)
-        self.parseshort(self.__LENGTH__)
-        self.parseshort(self.__IDENT__)
-        self.parseflags()
-        self.parsebyte(self.__TTL__)
-        self.parsebyte(self.__PROTOCOL__)
-        self.parseshort(self.__CHECKSUM__)
-        self.parseaddr(self.__SRC__)
-        self.parseaddr(self.__DST__)
-        self.parseoptions()
-        self.parsenext()
-
-        self.pop(self.__INT_PTR__, None)
-
-    def parsevhl(self):
-        p = self[self.__INT_PTR__]
-
-        x = self[self.__BYTES__][p]
-        self[self.__VERSION__] = (x >> 4) & 0x0f
-        self[self.__IHL__] = (x & 0x0f)
-
-        self[self.__INT_PTR__] = p + 1
-
-    def parsebyte(self, n):
-        p = self[self.__INT_PTR__]
-        self[n] = self[self.__BYTES__][p]
-        self[self.__INT_PTR__] = p + 1
-
-    def parseshort(self, n):
-        p = self[self.__INT_PTR__]
-        self[n] = (self[self.__BYTES__][p] << 8) | self[self.__BYTES__][p + 1]
-        self[self.__INT_PTR__] = p + 2
-
-    def parseint(self, n):
-        p = self[self.__INT_PTR__]
-        self[n] = ((self[self.__BYTES__][p] << 24) |
-                   (self[self.__BYTES__][p + 1] << 16) |
-                   (self[self.__BYTES__][p + 2] << 8) |
-                   (self[self.__BYTES__][p + 3]))
-
-        self[self.__INT_PTR__] = p + 4
-
-    def parseflags(self):
-        self.parseshort(self.__INT_FOFF__)
-        x = self[self.__INT_FOFF__]
-        self[self.__FLAGS__] = (x >> 13) & 0x07
-        self[self.__OFFSET__] = x & 0x1fff
-        self.pop(self.__INT_FOFF__, None)
+        if self.lazy:
+            # All we need up front is where the payload starts
+            p = max(codec.IP.size, (b[0] & 0x0f) * 4)
+            dict.__setitem__(self, self.__NEXTDATA__, b[p:])
+            self.dirty = False
+            return
+
+        (vhl, tos, length, ident, foff, ttl, protocol, checksum,
+         src, dst) = codec.IP.unpack_from(b)
+
+        # Fields that come off the wire go straight into the dict, past
+        # __setitem__, as they don't make us dirty
+        dict.update(self, {
+            self.__VERSION__: (vhl >> 4) & 0x0f,
+            self.__IHL__: vhl & 0x0f,
+            self.__TOS__: tos,
+            self.__LENGTH__: length,
+            self.__IDENT__: ident,
+            self.__FLAGS__: (foff >> 13) & 0x07,
+            self.__OFFSET__: foff & 0x1fff,
+            self.__TTL__: ttl,
+            self.__PROTOCOL__: protocol,
+            self.__CHECKSUM__: checksum,
+            self.__SRC__: self.parseaddr(src),
+            self.__DST__: self.parseaddr(dst),
+            })
+
+        p = self.parseoptions(codec.IP.size)
+        dict.__setitem__(self, self.__NEXTDATA__, b[p:])
+
+        # Everything set so far came off the wire
+        self.dirty = False
 
     # We keep this as an unparsed array because we may not want to raise an
     # error if something is wrong in the formatting.
     # Also, this is very lazy. We don't check for extra data or even if the
     # payload length matches what the header defines.
-    def parseoptions(self):
+    def parseoptions(self, p):
         # Always go by the header length to get the option boundary
         l = self[self.__IHL__]
-        if (l * 4) <= 20:
-            return
-
-        l = (l * 4) - 20
-
-        p = self[self.__INT_PTR__]
-        self[self.__OPTIONS__] = [self[self.__BYTES__][p:p+l]]
-        self[self.__INT_PTR__] = p + l
-
-    def parsenext(self):
-        p = self[self.__INT_PTR__]
-        self[self.__NEXTDATA__] = self[self.__BYTES__][p:]
-        self[self.__INT_PTR__] = p + len(self[self.__NEXTDATA__])
-
-    def parseaddr(self, n):
-        p = self[self.__INT_PTR__]
-        self[n] = socket.inet_ntoa(self[self.__BYTES__][p:p+4])
-        self[self.__INT_PTR__] = p + 4
-
+        if (l * 4) <= codec.IP.size:
+            return p
+
+        l = (l * 4) - codec.IP.size
+        dict.__setitem__(self, self.__OPTIONS__, [self[self.__BYTES__][p:p+l]])
+        return p + l
+
+    # Decode every field a lazy parse hasn't been asked for yet
+    def decode(self):
+        for i in self.__FIELDS__:
+            if i not in self.itemlist:
+                self.get(i)
+
+    def parsefield(self, n):
+        b = self[self.__BYTES__]
+        if n == self.__VERSION__:
+            return (b[0] >> 4) & 0x0f
+        elif n == self.__IHL__:
+            return b[0] & 0x0f
+        elif n == self.__TOS__:
+            return b[1]
+        elif n == self.__LENGTH__:
+            return codec.SHORT.unpack_from(b, 2)[0]
+        elif n == self.__IDENT__:
+            return codec.SHORT.unpack_from(b, 4)[0]
+        elif n == self.__FLAGS__:
+            return (b[6] >> 5) & 0x07
+        elif n == self.__OFFSET__:
+            return codec.SHORT.unpack_from(b, 6)[0] & 0x1fff
+        elif n == self.__TTL__:
+            return b[8]
+        elif n == self.__PROTOCOL__:
+            return b[9]
+        elif n == self.__CHECKSUM__:
+            return codec.SHORT.unpack_from(b, 10)[0]
+        elif n == self.__SRC__:
+            return self.parseaddr(b[12:16])
+        elif n == self.__DST__:
+            return self.parseaddr(b[16:20])
+        elif n == self.__OPTIONS__:
+            l = (b[0] & 0x0f) * 4
+            if l > codec.IP.size:
+                return [b[codec.IP.size:l]]
+        raise KeyError(n)
+
+    # With 'numeric' set, addresses are kept as numbers (see codec.IPv4) and
+    # only spelled out if something asks for the text
+    def parseaddr(self, b):
+        if self.numeric:
+            return codec.IPv4.from_bytes(b, "big")
+        return socket.inet_ntoa(b)
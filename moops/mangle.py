@@ -1,6 +1,20 @@
+from moops import codec
+from moops import checksum
+from moops import dispatch
 from moops.ether import Ether
-from moops.udp import UDP
 from moops.ip import IP
+from moops.udp import UDP
+
+# The fields of each layer, for plan()
+LAYERS = [
+    (Ether, codec.ETHER_FIELDS),
+    (IP, codec.IP_FIELDS),
+    (UDP, codec.UDP_FIELDS),
+    ]
+
+# Fields the layers work out for themselves (and that apply() fixes up), so
+# an assignment to one is no part of a plan
+DERIVED = ["ihl", "length", "checksum"]
 
 class Mangle(dict):
     # This is a module that should be customized on a per-effort basis. The
@@ -15,6 +29,15 @@ class Mangle(dict):
         __MANGLE__
         ]
 
+    # Whether a Fling keeping a flow table may plan() our update() once per
+    # flow and apply() that plan to the rest of it. Only for an update()
+    # that changes a frame by assigning header fields of the layers decoded
+    # from it, with values that depend on nothing but the flow (not e.g.
+    # one that decrements the TTL). Mangle leaves it False. A subclass of
+    # one that sets it inherits it, and must set it back to False if its
+    # own update() does more.
+    planned = False
+
     itemlist = None
 
     def __init__(self, *args, **kw):
@@ -32,12 +55,134 @@ class Mangle(dict):
         return k
 
     def update(self, x):
-        e = Ether({'bytes': x})
-        i = IP({'bytes': e.next(), 'prev': e})
-        u = UDP({'bytes': i.next(), 'prev': i})
-        e['next'] = i
-        i['next'] = u
-
-        i['src'] = '1.2.3.4'
+        # The UDP header is decoded too, when the new source address goes
+        # into its checksum
+        e = dispatch.decode(x)
+        e['next']['src'] = '1.2.3.4'
 
         return bytes(e)
+
+    def __call__(self, x):
+        return self.update(x)
+
+    # For a Fling keeping a flow table, when we're 'planned': what update()
+    # did to frame x, as header bytes to overwrite, so the rest of x's flow
+    # can be patched the same way without being decoded. Every field
+    # update() assigns goes into the plan at its full width, even where the
+    # value it got happens to be what x had already. Returns the plan, or
+    # None when update() did anything a plan can't repeat, along with
+    # update()'s output for x itself.
+    def plan(self, x):
+        log = []
+        codec.ASSIGNED.log = log
+        try:
+            y = self.update(x)
+        finally:
+            codec.ASSIGNED.log = None
+
+        h = self.headers(x)
+        if h is None or y is None or len(y) != len(x):
+            return None, y
+        ip, l, udp = h
+
+        # Everything past the headers must be left as it was
+        end = ip + l
+        if udp is not None:
+            end = udp + codec.UDP.size
+        if x[end:] != y[end:]:
+            return None, y
+
+        starts = [0, ip, udp]
+        patches = {}
+        for layer, k in log:
+            if k in DERIVED:
+                continue
+            for i, (c, fields) in enumerate(LAYERS):
+                if isinstance(layer, c):
+                    break
+            # Only fields of the layers decoded from x can be patched
+            if not layer.inbound or starts[i] is None:
+                return None, y
+            o, n, mask, shift = fields[k]
+            if n is None:
+                # Options may change the header's length
+                return None, y
+            a = starts[i] + o
+            patches[(a, mask)] = (a, bytes(y[a:a+n]), mask)
+
+        # Anything update() changed other than by assigning fields shows up
+        # as a difference here
+        p = (list(patches.values()), h)
+        if self.apply(x, p) != y:
+            return None, y
+        return p, y
+
+    # Patch frame x by plan p, fixing its IP and UDP checksums up for the
+    # words that changed (RFC 1624), just as the layers would. A frame laid
+    # out differently from the one p was made for (e.g. with IP options
+    # where that one had none) is updated in full instead.
+    def apply(self, x, p):
+        patches, h = p
+        if self.headers(x) != h:
+            return self.update(x)
+        ip, l, udp = h
+
+        y = bytearray(x)
+        for o, v, mask in patches:
+            if mask is None:
+                y[o:o+len(v)] = v
+                continue
+            # A field sharing its bytes with others
+            w = codec.WORDS[len(v)]
+            m = w.unpack_from(y, o)[0]
+            w.pack_into(y, o, (m & ~mask) | (w.unpack_from(v)[0] & mask))
+
+        c = codec.SHORT.unpack_from(x, ip + 10)[0]
+        c = checksum.update(c, x[ip:ip+10], y[ip:ip+10])
+        c = checksum.update(c, x[ip+12:ip+l], y[ip+12:ip+l])
+        codec.SHORT.pack_into(y, ip + 10, c)
+
+        if udp is not None:
+            c = codec.SHORT.unpack_from(x, udp + 6)[0]
+            # The pseudo header: addresses, then the protocol as a word
+            c = checksum.update(c, x[ip+12:ip+20], y[ip+12:ip+20])
+            c = checksum.update(c, b"\0" + x[ip+9:ip+10],
+                                b"\0" + y[ip+9:ip+10])
+            c = checksum.update(c, x[udp:udp+6], y[udp:udp+6])
+            # Zero means "no checksum"; send its other form, as the layers do
+            codec.SHORT.pack_into(y, udp + 6, c or 0xffff)
+
+        return bytes(y)
+
+    # Where the IP header of frame x starts and how long it is, and where
+    # its UDP header starts (None without one). None if x isn't a frame a
+    # plan can be made for.
+    def headers(self, x):
+        if len(x) < 14 + codec.IP.size:
+            return None
+        if codec.SHORT.unpack_from(x, 12)[0] != 0x0800:
+            return None
+
+        # The layers rewrite lengths to fit what they hold, and pad odd ones
+        # out to even, which a plan can't do, so only frames whose lengths
+        # already fit will do
+        if len(x) & 1:
+            return None
+        ip = 14
+        l = (x[ip] & 0x0f) * 4
+        if l < codec.IP.size or len(x) < ip + l:
+            return None
+        if codec.SHORT.unpack_from(x, ip + 2)[0] != len(x) - ip:
+            return None
+
+        udp = None
+        first = not codec.SHORT.unpack_from(x, ip + 6)[0] & 0x1fff
+        if x[ip + 9] == 17 and first:
+            udp = ip + l
+            if len(x) < udp + codec.UDP.size:
+                return None
+            n, c = codec.UDP.unpack_from(x, udp)[2:]
+            # A datagram sent without a checksum gets one computed in full
+            if n != len(x) - udp or not c:
+                return None
+        return ip, l, udp
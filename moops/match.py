@@ -1,3 +1,11 @@
+import struct
+
+from moops import codec
+from moops.ether import Ether
+from moops.ip import IP
+from moops.udp import UDP
+
+
 class Match(dict):
 
     __NAME__ = "name"
@@ -8,13 +16,28 @@ class Match(dict):
         __MATCH__
         ]
 
+    # Bookkeeping keys of the template layers
+    __NEXT__ = "next"
+
     itemlist = None
 
+    # The compiled template: see compile()
+    tests = None
+    hops = None
+    tail = None
+    compiled = False
+
     def __init__(self, *args, **kw):
         dict.__init__(self, *args, **kw)
         self.itemlist = super(Match, self).keys()
         self[self.__NAME__] = "Match"
 
+    # A new template has to be compiled again
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, v)
+        if k == self.__MATCH__:
+            self.compiled = False
+
     def __hash__(self):
         return hash(tuple(sorted(self.items())))
 
@@ -25,4 +48,140 @@ class Match(dict):
         return k
 
     def __eq__(self, x):
-        return self[self.__MATCH__] == x
+        if not self.compiled:
+            self.compile()
+
+        # Not a layer chain we know how to flatten; let it compare itself
+        if self.tests is None:
+            return self[self.__MATCH__] == x
+
+        # Walk the tests in layer order, working out where each layer starts
+        # only once a test needs it
+        p = 0
+        l = 0
+        try:
+            for i, o, w, m, v in self.tests:
+                while l < i:
+                    p += self.hop(x, p, l)
+                    l += 1
+                if w.unpack_from(x, p + o)[0] & m != v:
+                    return False
+
+            if self.tail is not None:
+                i, v = self.tail
+                while l < i:
+                    p += self.hop(x, p, l)
+                    l += 1
+                return x[p:] == v
+        except (IndexError, struct.error):
+            # Too short to hold the fields we're after
+            return False
+
+        return True
+
+    # The length of layer l, starting at p in frame x
+    def hop(self, x, p, l):
+        h = self.hops[l]
+        if h is None:
+            h = max(codec.IP.size, (x[p] & 0x0f) * 4)
+        return h
+
+    # Flatten the template chain (Ether -> IP -> UDP -> payload) into a list
+    # of (layer, offset, word, mask, value) tests against the raw frame,
+    # where word is the Struct reading 1, 2 or 4 bytes at offset within the
+    # layer. hops gives each layer's length (None meaning it comes from the
+    # IP header length) and tail is the payload, if any, that must follow the
+    # last layer exactly. Matching a frame then builds no objects at all.
+    #
+    # This happens on the first comparison. Call it again after changing the
+    # template in place.
+    def compile(self):
+        self.tests = None
+        self.hops = None
+        self.tail = None
+        self.compiled = True
+
+        t = self.get(self.__MATCH__)
+        if not isinstance(t, (Ether, IP, UDP)):
+            return
+
+        tests = {}
+        hops = []
+        tail = None
+        l = 0
+        while True:
+            if isinstance(t, Ether):
+                f = codec.ETHER_FIELDS
+                hops.append(codec.ETHER.size)
+            elif isinstance(t, IP):
+                f = codec.IP_FIELDS
+                hops.append(None)
+            else:
+                f = codec.UDP_FIELDS
+                hops.append(codec.UDP.size)
+
+            for k in t.itemlist:
+                if k not in f:
+                    continue
+                o, n, m, s = f[k]
+                v = self.encode(t, k, t[k])
+                if m is None:
+                    m = (1 << (8 * len(v))) - 1
+                    v = int.from_bytes(v, "big")
+                else:
+                    v = (v << s) & m
+                self.add(tests, l, o, n or (m.bit_length() + 7) // 8, m, v)
+
+            # Options only match a header that holds exactly those options
+            if (isinstance(t, IP) and IP.__OPTIONS__ in t.itemlist and
+                    IP.__IHL__ not in t.itemlist):
+                h = codec.IP.size + len(self.encode(t, IP.__OPTIONS__,
+                                                    t[IP.__OPTIONS__]))
+                self.add(tests, l, 0, 1, 0x0f, (h // 4) & 0x0f)
+
+            if self.__NEXT__ not in t.itemlist:
+                break
+
+            t = t[self.__NEXT__]
+            l += 1
+            if isinstance(t, (Ether, IP, UDP)):
+                continue
+
+            # Anything else is payload, which must match exactly
+            if not isinstance(t, (bytes, bytearray, memoryview)):
+                return
+            tail = (l, bytes(t))
+            break
+
+        self.tests = sorted(tests.values(), key=lambda i: (i[0], i[1]))
+        self.hops = hops
+        self.tail = tail
+
+    # Split a field into tests of at most 4 bytes, merging any that land on
+    # the same word as an earlier one (e.g. version and ihl).
+    def add(self, tests, l, o, n, m, v):
+        while n > 0:
+            w = 4
+            while w > n:
+                w >>= 1
+            n -= w
+            s = 8 * n
+            k = (l, o, w)
+            x = tests.get(k, (l, o, codec.WORDS[w], 0, 0))
+            tests[k] = (l, o, x[2],
+                        x[3] | ((m >> s) & ((1 << (8 * w)) - 1)),
+                        x[4] | ((v >> s) & ((1 << (8 * w)) - 1)))
+            o += w
+
+    # A template value in wire form: bytes for addresses and options, an
+    # integer for everything else
+    def encode(self, t, k, v):
+        if isinstance(t, Ether):
+            if codec.ETHER_FIELDS[k][2] is None:
+                return codec.mac_aton(v)
+        elif isinstance(t, IP):
+            if k == IP.__OPTIONS__:
+                return b''.join(v)
+            if codec.IP_FIELDS[k][2] is None:
+                return codec.ip_aton(v)
+        return int(v)
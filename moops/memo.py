@@ -0,0 +1,147 @@
+import struct
+from collections import OrderedDict
+
+from moops import codec
+
+
+# Remember what a mangle made of each frame, for mangles that always make
+# the same frame out of the same input (e.g. answering a repeated query), so
+# a frame seen before costs a lookup instead of a parse and a rebuild.
+#
+#   m = Memo(Mangle(), 4096)             # keyed on the whole frame
+#   m = Memo(f, 4096, ["ip.src", "udp.src", ("payload", 0, 12)])
+#   y = m(x)
+#
+# A key of fields (named as for a Template) says the output depends on
+# those fields alone, so frames that differ anywhere else share an entry;
+# it's for the caller to be sure that's so. Frames too short to hold every
+# field aren't cached. The least recently used entry makes way once there
+# are 'size' of them.
+
+PAYLOAD = "payload"
+
+# The fields of each layer
+LAYERS = {
+    "ether": codec.ETHER_FIELDS,
+    "ip": codec.IP_FIELDS,
+    "udp": codec.UDP_FIELDS,
+    }
+
+# Not in the cache, as opposed to a cached None (the frame was dropped)
+MISSING = object()
+
+
+class Memo:
+    def __init__(self, mangle=None, size=4096, key=None):
+        self.mangle = mangle
+        self.size = size
+        self.cache = OrderedDict()
+
+        self.fields = None
+        if key is not None:
+            self.fields = [self.field(f) for f in key]
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __call__(self, x):
+        return self.call(self.mangle, x)
+
+    # Work out how to read field f: (layer, offset, size, word, mask)
+    def field(self, f):
+        if isinstance(f, tuple):
+            name, o, n = f
+        else:
+            name, o, n = f, 0, None
+
+        if name == PAYLOAD:
+            return (PAYLOAD, o, n, None, None)
+
+        l, k = name.split(".", 1)
+        if l not in LAYERS or k not in LAYERS[l]:
+            raise Exception("No such memo key field: {0}".format(name))
+        o, n, mask, shift = LAYERS[l][k]
+        word = None
+        if mask is not None:
+            word = codec.WORDS[(mask.bit_length() + 7) // 8]
+        return (l, o, n, word, mask)
+
+    # Frame x's key, or None if it's too short to have one
+    def key(self, x):
+        if self.fields is None:
+            return bytes(x)
+
+        try:
+            ip = codec.ETHER.size
+            udp = ip + max(codec.IP.size, (x[ip] & 0x0f) * 4)
+            starts = {
+                "ether": 0,
+                "ip": ip,
+                "udp": udp,
+                PAYLOAD: udp + codec.UDP.size,
+                }
+
+            k = []
+            for l, o, n, word, mask in self.fields:
+                a = starts[l] + o
+                if word is not None:
+                    k.append(word.unpack_from(x, a)[0] & mask)
+                    continue
+                if n is None and l == PAYLOAD:
+                    n = len(x) - a
+                elif n is None:
+                    # IP options, up to where the header ends
+                    n = udp - a
+                if a + n > len(x):
+                    return None
+                k.append(bytes(x[a:a+n]))
+        except (IndexError, struct.error):
+            return None
+        return tuple(k)
+
+    # What mangle m makes of frame x, from the cache if it's been seen
+    def call(self, m, x):
+        k = self.key(x)
+        if k is None:
+            return m(x)
+
+        # One cache can serve several mangles
+        k = (id(m), k)
+        y = self.cache.get(k, MISSING)
+        if y is not MISSING:
+            self.cache.move_to_end(k)
+            self.hits += 1
+            return y
+
+        self.misses += 1
+        y = m(x)
+        # A view may be into a buffer that's about to be reused
+        if y is not None and not isinstance(y, bytes):
+            y = bytes(y)
+
+        while len(self.cache) >= self.size:
+            self.cache.popitem(last=False)
+            self.evicted += 1
+        self.cache[k] = y
+        return y
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        n = self.hits + self.misses
+        r = 0
+        if n:
+            r = self.hits / n
+        return {
+            "size": len(self.cache),
+            "capacity": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitrate": r,
+            "evicted": self.evicted,
+            }
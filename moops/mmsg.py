@@ -0,0 +1,128 @@
+import os
+import errno
+import ctypes
+import ctypes.util
+
+
+# Batched socket I/O through recvmmsg(2)/sendmmsg(2), which Python's socket
+# module doesn't expose. A Batch owns one contiguous buffer split into
+# fixed-size slots, and the iovec/mmsghdr arrays pointing into them are built
+# once, so a syscall moves up to a whole batch of frames with no per-frame
+# allocation on our side.
+
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+MSG_DONTWAIT = 0x40
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+        ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+        ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint),
+        ]
+
+
+libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr),
+                          ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+libc.recvmmsg.restype = ctypes.c_int
+libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr),
+                          ctypes.c_uint, ctypes.c_int]
+libc.sendmmsg.restype = ctypes.c_int
+
+
+class Batch:
+    # Slot size; as large as anything Fling.recv() would take in
+    __SNAPLEN__ = 65536
+
+    def __init__(self, s, size, snaplen=__SNAPLEN__):
+        self.sock = s
+        self.size = size
+        self.snaplen = snaplen
+
+        self.buf = (ctypes.c_char * (size * snaplen))()
+        self.view = memoryview(self.buf).cast('B')
+        self.iov = (iovec * size)()
+        self.msgs = (mmsghdr * size)()
+
+        base = ctypes.addressof(self.buf)
+        for i in range(size):
+            self.iov[i].iov_base = base + i * snaplen
+            self.iov[i].iov_len = snaplen
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iov[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+
+        # Frames put() but not yet flush()ed
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    # Take in whatever is already queued on the socket, up to a full batch,
+    # without blocking. The frames are views into our slots, so they're only
+    # valid until the next call.
+    def recv(self):
+        n = libc.recvmmsg(self.sock.fileno(), self.msgs, self.size,
+                          MSG_DONTWAIT, None)
+        if n < 0:
+            e = ctypes.get_errno()
+            if e in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(e, os.strerror(e))
+
+        s = self.snaplen
+        return [self.view[i * s:i * s + self.msgs[i].msg_len]
+                for i in range(n)]
+
+    # Copy a frame into the next free slot. It's safe to reuse whatever x
+    # points into as soon as this returns.
+    def put(self, x):
+        n = len(x)
+        if n > self.snaplen:
+            raise Exception("Frame larger than the batch slot size")
+
+        i = self.count
+        p = i * self.snaplen
+        self.view[p:p+n] = x
+        self.iov[i].iov_len = n
+        self.count = i + 1
+        return self.count
+
+    def full(self):
+        return self.count >= self.size
+
+    # Send every frame put() so far; returns how many went out
+    def flush(self):
+        sent = 0
+        while sent < self.count:
+            p = ctypes.addressof(self.msgs) + sent * ctypes.sizeof(mmsghdr)
+            m = ctypes.cast(p, ctypes.POINTER(mmsghdr))
+            n = libc.sendmmsg(self.sock.fileno(), m, self.count - sent, 0)
+            if n < 0:
+                e = ctypes.get_errno()
+                if e == errno.EINTR:
+                    continue
+                self.count = 0
+                raise OSError(e, os.strerror(e))
+            sent += n
+
+        self.count = 0
+        return sent
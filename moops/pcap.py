@@ -0,0 +1,265 @@
+import os
+import mmap
+import time
+import struct
+
+
+# Captures on disk, in the classic pcap format or in pcapng.
+#
+# A Reader maps the whole file and walks it record by record, handing out
+# each frame as a view straight into the mapping, so nothing is copied and
+# only the pages being looked at need be in memory, however large the file.
+# A Writer collects records in a buffer and appends them to the file a
+# buffer at a time.
+#
+#   for ts, x in Reader("in.pcap"):
+#       ...
+#
+# replay() runs a capture through a Fling's match and mangle, as if the
+# frames had come in on its input interface.
+
+# Link type of every frame we deal in
+LINKTYPE_ETHERNET = 1
+
+# Classic pcap: magic, major, minor, thiszone, sigfigs, snaplen, linktype
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAP_HEADER = "IHHiIII"
+
+# ts_sec, ts_usec (or nsec), incl_len, orig_len
+PCAP_RECORD = "IIII"
+
+# pcapng block types
+SHB = 0x0a0d0d0a
+IDB = 0x00000001
+SPB = 0x00000003
+EPB = 0x00000006
+
+# The byte order magic in a section header
+BYTE_ORDER = 0x1a2b3c4d
+
+# The interface option giving the timestamp resolution
+IF_TSRESOL = 9
+
+
+class Reader:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        # An empty file can't be mapped at all
+        if os.fstat(self.file.fileno()).st_size < 4:
+            self.file.close()
+            raise Exception("Not a capture file: {0}".format(path))
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self.map, "madvise"):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+        self.view = memoryview(self.map)
+
+        m = struct.unpack_from("<I", self.map, 0)[0]
+        if m == SHB:
+            self.format = "pcapng"
+        elif m in (PCAP_MAGIC, PCAP_MAGIC_NS):
+            self.format = "pcap"
+            self.order = "<"
+        elif struct.unpack_from(">I", self.map, 0)[0] in (PCAP_MAGIC,
+                                                          PCAP_MAGIC_NS):
+            self.format = "pcap"
+            self.order = ">"
+        else:
+            raise Exception("Not a capture file: {0}".format(path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Every record, as (timestamp in seconds, frame). The frames are views
+    # into the file; copy any that must outlive the Reader.
+    def __iter__(self):
+        if self.format == "pcap":
+            return self.pcap()
+        return self.pcapng()
+
+    def pcap(self):
+        o = self.order
+        h = struct.Struct(o + PCAP_HEADER)
+        r = struct.Struct(o + PCAP_RECORD)
+
+        m = h.unpack_from(self.map, 0)[0]
+        scale = 1e-9 if m == PCAP_MAGIC_NS else 1e-6
+
+        v = self.view
+        end = len(v)
+        p = h.size
+        while p + r.size <= end:
+            s, f, n, l = r.unpack_from(v, p)
+            p += r.size
+            if p + n > end:
+                # Truncated by a capture that didn't finish
+                return
+            yield s + f * scale, v[p:p+n]
+            p += n
+
+    def pcapng(self):
+        v = self.view
+        end = len(v)
+        o = "<"
+        scales = []
+        p = 0
+        while p + 12 <= end:
+            t = struct.unpack_from(o + "I", v, p)[0]
+
+            if t == SHB:
+                # Each section sets its own byte order and interfaces
+                if struct.unpack_from("<I", v, p + 8)[0] == BYTE_ORDER:
+                    o = "<"
+                else:
+                    o = ">"
+                scales = []
+
+            n = struct.unpack_from(o + "I", v, p + 4)[0]
+            if n < 12 or p + n > end:
+                return
+
+            if t == IDB:
+                scales.append(self.resolution(v, p + 16, p + n - 4, o))
+            elif t == EPB:
+                i, hi, lo, c = struct.unpack_from(o + "IIII", v, p + 8)
+                # A packet from an interface the section never described
+                if i >= len(scales):
+                    raise Exception("Not a capture file: {0}".format(
+                        self.path))
+                yield (((hi << 32) | lo) * scales[i],
+                       v[p + 28:p + 28 + c])
+            elif t == SPB:
+                l = struct.unpack_from(o + "I", v, p + 8)[0]
+                yield 0.0, v[p + 12:p + 12 + min(l, n - 16)]
+
+            p += n
+
+    # An interface's timestamp unit, from its if_tsresol option (in
+    # microseconds if it has none)
+    def resolution(self, v, p, end, o):
+        while p + 4 <= end:
+            c, l = struct.unpack_from(o + "HH", v, p)
+            if c == 0:
+                break
+            if c == IF_TSRESOL and l >= 1:
+                r = v[p + 4]
+                if r & 0x80:
+                    return 2.0 ** -(r & 0x7f)
+                return 10.0 ** -r
+            p += 4 + ((l + 3) & ~3)
+        return 1e-6
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # A frame view is still held somewhere; the mapping goes with it
+            pass
+        self.file.close()
+
+
+class Writer:
+    # Records are appended a buffer at a time
+    __BUFSIZE__ = 1 << 20
+
+    def __init__(self, path, format="pcap", snaplen=65535,
+                 linktype=LINKTYPE_ETHERNET, bufsize=__BUFSIZE__):
+        if format not in ("pcap", "pcapng"):
+            raise Exception("Unknown capture format: {0}".format(format))
+
+        self.format = format
+        self.snaplen = snaplen
+        self.bufsize = bufsize
+        self.buf = bytearray()
+        self.count = 0
+        self.pending = 0
+        self.file = open(path, "wb")
+
+        if format == "pcap":
+            self.buf += struct.pack("<" + PCAP_HEADER, PCAP_MAGIC, 2, 4, 0, 0,
+                                    snaplen, linktype)
+        else:
+            self.buf += struct.pack("<IIIHHq", SHB, 28, BYTE_ORDER, 1, 0, -1)
+            self.buf += struct.pack("<I", 28)
+            self.buf += struct.pack("<IIHHII", IDB, 20, linktype, 0, snaplen,
+                                    20)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.pending
+
+    # Add frame x, stamped ts (now, if not given)
+    def write(self, x, ts=None):
+        if ts is None:
+            ts = time.time()
+        n = len(x)
+        c = min(n, self.snaplen)
+
+        if self.format == "pcap":
+            s = int(ts)
+            self.buf += struct.pack("<IIII", s, int((ts - s) * 1e6), c, n)
+            self.buf += x[:c]
+        else:
+            t = int(ts * 1e6)
+            pad = -c & 3
+            self.buf += struct.pack("<IIIIIII", EPB, 32 + c + pad, 0,
+                                    t >> 32, t & 0xffffffff, c, n)
+            self.buf += x[:c]
+            self.buf += bytes(pad)
+            self.buf += struct.pack("<I", 32 + c + pad)
+
+        self.count += 1
+        self.pending += 1
+        if len(self.buf) >= self.bufsize:
+            self.drain()
+
+    # So a Writer can stand in wherever frames are put() and flush()ed
+    def put(self, x):
+        self.write(x)
+        return self.pending
+
+    def full(self):
+        return False
+
+    def drain(self):
+        if self.buf:
+            self.file.write(self.buf)
+            self.buf = bytearray()
+
+    # Append everything buffered, all the way to the file; returns how many
+    # records were written since the last flush
+    def flush(self):
+        self.drain()
+        self.file.flush()
+        n = self.pending
+        self.pending = 0
+        return n
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+# Run every frame of capture r through Fling f's match and mangle, writing
+# whatever would have been sent to Writer w (if any). Returns f's counters.
+def replay(f, r, w=None):
+    for ts, x in r:
+        y = f.process(x)
+        if y is None:
+            continue
+        f.counters[f.__SENT__] += 1
+        if w is not None:
+            w.write(y, ts)
+    if w is not None:
+        w.flush()
+    return f.counters
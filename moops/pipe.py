@@ -0,0 +1,75 @@
+import threading
+
+
+# A bounded ring queue between two pipeline stages. The slots are allocated
+# once; put() and get() move a head and a tail around them under one lock.
+# When the queue is full, put() either drops the item ("drop") or waits for
+# room ("block"), depending on the policy. The queue keeps its current depth,
+# the deepest it has been, and how many items it has dropped.
+
+DROP = "drop"
+BLOCK = "block"
+
+
+class Queue:
+    def __init__(self, size, policy=DROP):
+        if policy not in (DROP, BLOCK):
+            raise Exception("Unknown queue policy: {0}".format(policy))
+
+        self.size = size
+        self.policy = policy
+        self.slots = [None] * size
+        self.head = 0
+        self.count = 0
+
+        self.high = 0
+        self.dropped = 0
+
+        self.lock = threading.Lock()
+        self.readable = threading.Condition(self.lock)
+        self.writable = threading.Condition(self.lock)
+
+    def __len__(self):
+        return self.count
+
+    # Queue x. Returns False if it was dropped, or if timeout ran out while
+    # blocked waiting for room.
+    def put(self, x, timeout=None):
+        with self.lock:
+            if self.count == self.size:
+                if self.policy == DROP:
+                    self.dropped += 1
+                    return False
+                if not self.writable.wait_for(
+                        lambda: self.count < self.size, timeout):
+                    return False
+
+            self.slots[(self.head + self.count) % self.size] = x
+            self.count += 1
+            if self.count > self.high:
+                self.high = self.count
+            self.readable.notify()
+        return True
+
+    # The oldest item, or None if there's still nothing after timeout
+    def get(self, timeout=None):
+        with self.lock:
+            if not self.count:
+                if not self.readable.wait_for(lambda: self.count, timeout):
+                    return None
+
+            i = self.head
+            x = self.slots[i]
+            self.slots[i] = None
+            self.head = (i + 1) % self.size
+            self.count -= 1
+            self.writable.notify()
+        return x
+
+    def stats(self):
+        return {
+            "depth": self.count,
+            "high": self.high,
+            "size": self.size,
+            "dropped": self.dropped,
+            }
@@ -0,0 +1,185 @@
+import mmap
+import select
+import socket
+import struct
+
+
+# PACKET_MMAP rings (TPACKET_V3), the kernel's shared-memory alternative to
+# recv()/send() on an AF_PACKET socket. See
+# Documentation/networking/packet_mmap.rst in the kernel tree.
+#
+# On receive the kernel fills whole blocks of frames and flips each block
+# over to us; every frame is handed out as a memoryview straight into the
+# ring, and the block goes back to the kernel once we release it. On
+# transmit we write frames into free slots, mark them ready, and one send()
+# kicks the kernel into sending every ready slot.
+
+SOL_PACKET = getattr(socket, "SOL_PACKET", 263)
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+PACKET_TX_RING = 13
+TPACKET_V3 = 2
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+TP_STATUS_AVAILABLE = 0
+TP_STATUS_SEND_REQUEST = 1
+TP_STATUS_WRONG_FORMAT = 4
+
+# block_size, block_nr, frame_size, frame_nr, retire_blk_tov, sizeof_priv,
+# feature_req_word
+REQ3 = struct.Struct("IIIIIII")
+
+# struct tpacket_block_desc: version, offset_to_priv, then tpacket_hdr_v1's
+# block_status, num_pkts, offset_to_first_pkt
+BLOCK = struct.Struct("IIIII")
+BLOCK_STATUS = 8
+
+# struct tpacket3_hdr: next_offset, sec, nsec, snaplen, len, status, mac
+FRAME = struct.Struct("IIIIIIH")
+FRAME_STATUS = 20
+
+# Where transmitted data starts within a slot: TPACKET_ALIGN(sizeof(struct
+# tpacket3_hdr))
+TX_DATA = 48
+
+WORD = struct.Struct("I")
+
+
+class RxRing:
+    # 64 blocks of 1MiB; a block is handed over when full, or after
+    # __RETIRE__ ms, whichever comes first
+    __BLOCK_SIZE__ = 1 << 20
+    __BLOCK_NR__ = 64
+    __FRAME_SIZE__ = 2048
+    __RETIRE__ = 10
+
+    def __init__(self, s, block_size=__BLOCK_SIZE__, block_nr=__BLOCK_NR__,
+                 frame_size=__FRAME_SIZE__, retire=__RETIRE__):
+        self.sock = s
+        self.block_size = block_size
+        self.block_nr = block_nr
+
+        s.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        s.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                     REQ3.pack(block_size, block_nr, frame_size,
+                               (block_size // frame_size) * block_nr,
+                               retire, 0, 0))
+
+        self.map = mmap.mmap(s.fileno(), block_size * block_nr,
+                             mmap.MAP_SHARED,
+                             mmap.PROT_READ | mmap.PROT_WRITE)
+        self.view = memoryview(self.map)
+
+        # The next block the kernel will hand us
+        self.block = 0
+
+    # Wait up to timeout seconds (None for ever) for the next block; returns
+    # its index, or None if nothing arrived.
+    def wait(self, timeout=None):
+        i = self.block
+        p = i * self.block_size
+        if not WORD.unpack_from(self.map, p + BLOCK_STATUS)[0] & TP_STATUS_USER:
+            if not select.select([self.sock], [], [], timeout)[0]:
+                return None
+            if not WORD.unpack_from(self.map, p + BLOCK_STATUS)[0] & \
+                    TP_STATUS_USER:
+                return None
+
+        self.block = (i + 1) % self.block_nr
+        return i
+
+    # The frames in block i, as views into the ring. They're only valid
+    # until the block is released.
+    def frames(self, i):
+        p = i * self.block_size
+        n, o = BLOCK.unpack_from(self.map, p)[3:5]
+
+        f = []
+        p += o
+        for j in range(n):
+            h = FRAME.unpack_from(self.map, p)
+            f.append(self.view[p + h[6]:p + h[6] + h[3]])
+            p += h[0]
+        return f
+
+    # Hand block i back to the kernel
+    def release(self, i):
+        WORD.pack_into(self.map, i * self.block_size + BLOCK_STATUS,
+                       TP_STATUS_KERNEL)
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # A frame view is still held somewhere; the mapping goes with it
+            pass
+
+
+class TxRing:
+    __BLOCK_SIZE__ = 1 << 16
+    __BLOCK_NR__ = 64
+    __FRAME_SIZE__ = 2048
+
+    def __init__(self, s, block_size=__BLOCK_SIZE__, block_nr=__BLOCK_NR__,
+                 frame_size=__FRAME_SIZE__):
+        self.sock = s
+        self.block_size = block_size
+        self.frame_size = frame_size
+        self.per_block = block_size // frame_size
+        self.frame_nr = self.per_block * block_nr
+
+        s.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        s.setsockopt(SOL_PACKET, PACKET_TX_RING,
+                     REQ3.pack(block_size, block_nr, frame_size,
+                               self.frame_nr, 0, 0, 0))
+
+        self.map = mmap.mmap(s.fileno(), block_size * block_nr,
+                             mmap.MAP_SHARED,
+                             mmap.PROT_READ | mmap.PROT_WRITE)
+
+        # The next slot to fill, and how many are waiting to be sent
+        self.frame = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def slot(self, i):
+        return ((i // self.per_block) * self.block_size +
+                (i % self.per_block) * self.frame_size)
+
+    # Copy frame x into the next slot and mark it ready. If the ring is full
+    # of frames the kernel hasn't sent yet, kick it and wait for room.
+    def put(self, x):
+        n = len(x)
+        if n > self.frame_size - TX_DATA:
+            raise Exception("Frame larger than the ring slot size")
+
+        p = self.slot(self.frame)
+        while WORD.unpack_from(self.map, p + FRAME_STATUS)[0] not in \
+                (TP_STATUS_AVAILABLE, TP_STATUS_WRONG_FORMAT):
+            self.flush()
+            select.select([], [self.sock], [], 0.001)
+
+        self.map[p + TX_DATA:p + TX_DATA + n] = x
+        FRAME.pack_into(self.map, p, 0, 0, 0, n, n, TP_STATUS_SEND_REQUEST, 0)
+
+        self.frame = (self.frame + 1) % self.frame_nr
+        self.count += 1
+        return self.count
+
+    def full(self):
+        return self.count >= self.frame_nr
+
+    # Have the kernel send every ready slot
+    def flush(self):
+        n = self.count
+        if n:
+            self.sock.send(b'')
+            self.count = 0
+        return n
+
+    def close(self):
+        self.map.close()
@@ -0,0 +1,141 @@
+import struct
+
+from moops import codec
+from moops.ether import Ether
+from moops.ip import IP
+from moops.udp import UDP
+from moops.match import Match
+
+
+# Many Match templates, each with its own mangle, looked up together. The
+# first rule added that a frame matches is the one it gets.
+#
+#   r = RuleSet()
+#   r.add(Ether({'next': IP({'dst': '10.0.0.1'})}), mangle_a)
+#   r.add(Match({'match': ...}), mangle_b)
+#   rule = r.lookup(x)            # (number, match, mangle), or None
+#
+# Rather than trying every rule in turn, each rule is filed under one field
+# it pins down exactly: the destination IP address, UDP port or MAC address,
+# or the IP protocol, whichever files it alongside the fewest rules so far.
+# A frame only has to be tried against the rules filed under its own values
+# of those fields, plus the few wildcard rules that pin down none of them,
+# so lookups cost about the same however many rules there are.
+
+# The indexed fields, most discriminating first (which settles ties):
+# (layer, field)
+IP_DST = (1, "dst")
+UDP_DST = (2, "dst")
+ETHER_DST = (0, "dst")
+IP_PROTOCOL = (1, "protocol")
+
+FIELDS = [
+    IP_DST,
+    UDP_DST,
+    ETHER_DST,
+    IP_PROTOCOL,
+    ]
+
+# The class each layer of an indexable template must be
+LAYERS = [Ether, IP, UDP]
+
+
+class RuleSet:
+    def __init__(self, rules=()):
+        self.rules = []
+        self.indexes = dict((f, {}) for f in FIELDS)
+        self.wildcards = []
+        for r in rules:
+            self.add(*r)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __getitem__(self, n):
+        return self.rules[n]
+
+    # Add a rule: frames equal to match (a Match, or a layer chain to make
+    # one from) get mangle. Returns the rule's number.
+    def add(self, match, mangle=None):
+        if not isinstance(match, Match):
+            match = Match({Match.__MATCH__: match})
+
+        n = len(self.rules)
+        r = (n, match, mangle)
+        self.rules.append(r)
+
+        b = None
+        for f, v in self.keys(match):
+            l = len(self.indexes[f].get(v, ()))
+            if b is None or l < b[0]:
+                b = (l, f, v)
+        if b is None:
+            self.wildcards.append(r)
+        else:
+            self.indexes[b[1]].setdefault(b[2], []).append(r)
+        return n
+
+    # The fields rule m pins down, and its values there, in the same form
+    # values() reads them off a frame
+    def keys(self, m):
+        t = m.get(Match.__MATCH__)
+        layers = []
+        while isinstance(t, LAYERS[len(layers)]):
+            layers.append(t)
+            if len(layers) == len(LAYERS) or Match.__NEXT__ not in t.itemlist:
+                break
+            t = t[Match.__NEXT__]
+
+        keys = []
+        for f in FIELDS:
+            l, k = f
+            if l >= len(layers) or k not in layers[l].itemlist:
+                continue
+            v = m.encode(layers[l], k, layers[l][k])
+            if isinstance(v, bytes):
+                v = int.from_bytes(v, "big")
+            keys.append((f, v))
+        return keys
+
+    # Frame x's value of every indexed field it's long enough to hold.
+    # These are read where the rules' Match would read them, whatever the
+    # frame's actual type or protocol.
+    def values(self, x):
+        v = {}
+        try:
+            v[ETHER_DST] = int.from_bytes(x[0:6], "big")
+            v[IP_PROTOCOL] = x[23]
+            v[IP_DST] = codec.LONG.unpack_from(x, 30)[0]
+            h = max(codec.IP.size, (x[14] & 0x0f) * 4)
+            v[UDP_DST] = codec.SHORT.unpack_from(x, 14 + h + 2)[0]
+        except (IndexError, struct.error):
+            pass
+        return v
+
+    # The first rule (number, match, mangle) frame x matches, or None
+    def lookup(self, x):
+        c = []
+        for f, v in self.values(x).items():
+            r = self.indexes[f].get(v)
+            if r is not None:
+                c.append(r)
+        if self.wildcards:
+            c.append(self.wildcards)
+        if not c:
+            return None
+
+        # Each list is in rule order already; only a mix needs sorting
+        if len(c) == 1:
+            c = c[0]
+        else:
+            c = sorted(r for l in c for r in l)
+        for r in c:
+            if r[1] == x:
+                return r
+        return None
+
+    # So a RuleSet can stand in for a Match
+    def __eq__(self, x):
+        return self.lookup(x) is not None
+
+    __hash__ = object.__hash__
@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+from threading import Lock
+from threading import Thread
+
+
+# A sampling profiler for one thread, e.g. a Fling's. Every so often it
+# looks at where the thread is, and counts the stack it finds there, so a
+# slow mangle or an expensive template shows up without tracing every call
+# (as cProfile does, slowing down everything it measures). The thread being
+# sampled isn't touched at all: the cost is the sampler's own, taken from
+# it 'rate' times a second.
+#
+#   s = Sampler(threading.get_ident(), "/tmp/fling.folded", 99)
+#   s.start()
+#   ...
+#   s.join()
+#   s.write()
+#
+# Stacks are written collapsed, a line each, outermost frame first, ready
+# for flamegraph.pl or speedscope:
+#
+#   threading:Thread._bootstrap;...;moops.ip:IP.parse 12
+#
+# Frames are named module:function. Those in moops are ours, those in the
+# standard library nobody's in particular, and any others below Fling.run
+# are the user's (a mangle, a Match's callbacks). owners() says how the
+# samples split between us and the user, by whose code was running.
+
+PACKAGE = "moops"
+
+# Top level modules of the standard library
+STDLIB = getattr(sys, "stdlib_module_names", ())
+
+# Owners, see owners()
+MOOPS = "moops"
+USER = "user"
+
+# How often the stacks are written out while sampling, in seconds
+FLUSH = 5.0
+
+
+class Sampler(Thread):
+    def __init__(self, target, path=None, rate=99, depth=128):
+        Thread.__init__(self, daemon=True)
+        self.target = target
+        self.path = path
+        self.interval = 1.0 / rate
+        self.depth = depth
+        self.stacks = {}
+        self.names = {}
+        self.samples = 0
+        self.idle = 0
+        self.do_exit = False
+        self.lock = Lock()
+
+    # The name of frame f's function, and whose it is: True for ours, False
+    # for the user's, None for the standard library's. These are kept by
+    # code object, so each is only worked out once.
+    def name(self, f):
+        c = f.f_code
+        n = self.names.get(c)
+        if n is None:
+            m = f.f_globals.get("__name__", "?")
+            o = False
+            if m.split(".", 1)[0] == PACKAGE:
+                o = True
+            elif m.split(".", 1)[0] in STDLIB:
+                o = None
+            n = ("{0}:{1}".format(m, getattr(c, "co_qualname", c.co_name)),
+                 o)
+            self.names[c] = n
+        return n
+
+    # Count where the thread is now
+    def sample(self):
+        f = sys._current_frames().get(self.target)
+        if f is None:
+            self.idle += 1
+            return
+
+        s = []
+        while f is not None and len(s) < self.depth:
+            s.append(self.name(f))
+            f = f.f_back
+        s.reverse()
+
+        s = tuple(s)
+        self.stacks[s] = self.stacks.get(s, 0) + 1
+        self.samples += 1
+
+    def run(self):
+        t = time.monotonic() + FLUSH
+        while not self.do_exit:
+            time.sleep(self.interval)
+            self.sample()
+            if self.path is not None and time.monotonic() >= t:
+                self.write()
+                t = time.monotonic() + FLUSH
+
+    def join(self):
+        self.do_exit = True
+
+    # The collapsed stacks, as lines. Stacks may be counted as we go, from
+    # the sampler's thread, so we work from a copy.
+    def collapse(self):
+        l = []
+        for s, n in list(self.stacks.items()):
+            l.append("{0} {1}".format(";".join(k for k, m in s), n))
+        return l
+
+    # Write the collapsed stacks over the file at 'path' (replaced whole,
+    # so a reader never sees half of them). Both the sampler and whoever
+    # stops it may write, so one waits for the other.
+    def write(self, path=None):
+        if path is None:
+            path = self.path
+        t = path + ".tmp"
+        with self.lock:
+            with open(t, "w") as fp:
+                for l in self.collapse():
+                    fp.write(l + "\n")
+            os.replace(t, path)
+
+    # How many samples found moops' code running, and how many the user's.
+    # A sample is the user's if it's in their code, or in ours called from
+    # theirs (e.g. a mangle decoding its frame).
+    def owners(self):
+        o = {MOOPS: 0, USER: 0}
+        for s, n in list(self.stacks.items()):
+            # Past the first frame of ours, any of the user's makes it theirs
+            k = MOOPS
+            ours = False
+            for name, m in s:
+                if m:
+                    ours = True
+                elif m is not None and ours:
+                    k = USER
+                    break
+            if ours:
+                o[k] += n
+        return o
+
+    # The n functions most often found running, and how often
+    def top(self, n=10):
+        c = {}
+        for s, k in list(self.stacks.items()):
+            c[s[-1][0]] = c.get(s[-1][0], 0) + k
+        return sorted(c.items(), key=lambda i: -i[1])[:n]
+
+    def stats(self):
+        return {
+            "samples": self.samples,
+            "idle": self.idle,
+            "owners": self.owners(),
+            "top": self.top(),
+            }
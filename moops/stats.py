@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import socket
+from threading import Lock
+from threading import Thread
+
+
+# Latency histograms, and a thread that dumps snapshots of whatever's being
+# measured to a file or a UNIX socket every so often.
+#
+# A Histogram buckets values HDR style: exactly up to 2^bits, and above
+# that in 2^(bits-1) buckets per power of two, so any value is off by at
+# most one part in 2^(bits-1) of itself, however large, while recording one
+# is an index computation and an increment.
+
+# Values (nanoseconds, say) past 2^TOP all land in the last bucket
+TOP = 48
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+class Histogram:
+    def __init__(self, bits=6):
+        self.bits = bits
+        self.half = 1 << (bits - 1)
+        self.counts = [0] * ((1 << bits) + (TOP - bits) * self.half)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def index(self, v):
+        s = v.bit_length() - self.bits
+        if s <= 0:
+            return v
+        i = (1 << self.bits) + (s - 1) * self.half + (v >> s) - self.half
+        return min(i, len(self.counts) - 1)
+
+    # The smallest value that lands in bucket i
+    def value(self, i):
+        if i < (1 << self.bits):
+            return i
+        s, j = divmod(i - (1 << self.bits), self.half)
+        return (self.half + j) << (s + 1)
+
+    def record(self, v):
+        self.counts[self.index(v)] += 1
+        self.count += 1
+        self.total += v
+        if self.min is None or v < self.min:
+            self.min = v
+        if self.max is None or v > self.max:
+            self.max = v
+
+    # The value p percent of those recorded are no greater than (to within
+    # a bucket)
+    def percentile(self, p):
+        if not self.count:
+            return None
+        n = max(1, -(-self.count * p // 100))
+        c = 0
+        for i, k in enumerate(self.counts):
+            c += k
+            if c >= n:
+                return min(self.value(i), self.max)
+        return self.max
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def snapshot(self):
+        s = {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total / self.count if self.count else None,
+            }
+        for p in PERCENTILES:
+            s["p{0}".format(p).replace(".", "")] = self.percentile(p)
+        return s
+
+
+# Every 'interval' seconds, call f for a snapshot and write it out as JSON:
+# over the file at 'path' (replaced whole, so a reader never sees half of
+# one), and as a datagram to the UNIX socket at 'sock', if anything's
+# listening there.
+class Dump(Thread):
+    def __init__(self, f, path=None, sock=None, interval=1.0):
+        Thread.__init__(self, daemon=True)
+        self.f = f
+        self.path = path
+        self.sock = sock
+        self.interval = interval
+        self.do_exit = False
+        self._sock = None
+        self.lock = Lock()
+
+    def run(self):
+        while not self.do_exit:
+            time.sleep(self.interval)
+            self.dump()
+
+    # Both our thread and whoever stops it may dump, so one waits for the
+    # other
+    def dump(self):
+        b = json.dumps(self.f()).encode()
+
+        with self.lock:
+            if self.path is not None:
+                t = self.path + ".tmp"
+                with open(t, "wb") as fp:
+                    fp.write(b + b"\n")
+                os.replace(t, self.path)
+
+            if self.sock is not None:
+                if self._sock is None:
+                    self._sock = socket.socket(socket.AF_UNIX,
+                                               socket.SOCK_DGRAM)
+                try:
+                    self._sock.sendto(b, self.sock)
+                except OSError:
+                    # Nobody listening, or they're not keeping up
+                    pass
+
+    def join(self):
+        self.do_exit = True
@@ -0,0 +1,226 @@
+import struct
+
+from moops import codec
+from moops import checksum
+from moops.ether import Ether
+from moops.ip import IP
+from moops.udp import UDP
+
+
+# A frame serialized once, from which nearly identical frames are made by
+# patching a few fields in place. Every field that may vary is named up front
+# as "layer.field" (e.g. "ip.ident", "udp.src", "ether.dst"), or as
+# "payload", optionally with an offset and size into the payload:
+#
+#   t = Template(Ether({'next': IP({'next': UDP(...)})}),
+#                ["ip.ident", "udp.src", ("payload", 0, 4)])
+#   x = t.emit({"ip.ident": 7, "udp.src": 4000, "payload": b'ping'})
+#
+# A payload slot's value is given under "payload", or under its own (name,
+# offset, size) when there are several slots. Payload values must be bytes.
+#
+# Where each field sits, which 16-bit words it touches and which checksums
+# cover those words is all worked out here, so a patch writes only the
+# field's bytes and fixes the IP and UDP checksums up incrementally (RFC
+# 1624) rather than summing the headers and payload again.
+
+LAYERS = {
+    "ether": codec.ETHER_FIELDS,
+    "ip": codec.IP_FIELDS,
+    "udp": codec.UDP_FIELDS,
+    }
+
+PAYLOAD = "payload"
+
+# Fields of the IP header that are also in the UDP pseudo header
+PSEUDO = [
+    "ip.src",
+    "ip.dst",
+    "ip.protocol",
+    ]
+
+# A name shared by several payload slots, which can only be patched by their
+# own (name, offset, size)
+AMBIGUOUS = None
+
+# Fields that can't change without moving or resizing something else
+FIXED = [
+    "ip.ihl",
+    "ip.length",
+    "ip.options",
+    "ip.checksum",
+    "udp.length",
+    "udp.checksum",
+    ]
+
+
+class Template:
+    # The frame's length, when a pad byte has been added past its end
+    length = None
+
+    # Where the IP packet ends, short of any link layer padding
+    end = None
+
+    def __init__(self, chain, fields):
+        self.frame = bytearray(bytes(chain))
+        self.view = memoryview(self.frame)
+
+        # Where each layer starts
+        self.offsets = {}
+        o = 0
+        t = chain
+        while isinstance(t, (Ether, IP, UDP)):
+            if isinstance(t, Ether):
+                self.offsets["ether"] = o
+                o += codec.ETHER.size
+            elif isinstance(t, IP):
+                self.offsets["ip"] = o
+                o += (self.frame[o] & 0x0f) * 4
+            else:
+                self.offsets["udp"] = o
+                o += codec.UDP.size
+            t = t.get(Ether.__NEXT__)
+        self.offsets[PAYLOAD] = o
+
+        # The checksums to fix up: (offset, start, end, udp), where start and
+        # end bound the bytes covered in the frame
+        self.sums = []
+        ip = self.offsets.get("ip")
+        if ip is not None:
+            h = (self.frame[ip] & 0x0f) * 4
+            self.sums.append((ip + 10, ip, ip + h, False))
+
+            # The datagram runs to the end of the IP packet, whatever the UDP
+            # length says
+            self.end = ip + codec.SHORT.unpack_from(self.frame, ip + 2)[0]
+
+            u = self.offsets.get("udp")
+            if u is not None and codec.SHORT.unpack_from(self.frame, u + 6)[0]:
+                self.sums.append((u + 6, u, self.end, True))
+
+        self.fields = {}
+        for f in fields:
+            self.add(f)
+
+    # Work out how to patch field f: (offset, size, word, mask, shift,
+    # words, first word, checksums), where word reads and writes a masked
+    # field, and words reads every 16-bit word the field touches.
+    def add(self, f):
+        if isinstance(f, tuple):
+            name, o, n = f
+        else:
+            name, o, n = f, 0, None
+
+        if name in FIXED:
+            raise Exception("Template field can't vary: {0}".format(name))
+
+        word = None
+        mask = None
+        shift = 0
+        if name == PAYLOAD:
+            a = self.offsets[PAYLOAD] + o
+            if n is None:
+                n = (self.end or len(self.frame)) - a
+            if n <= 0 or a + n > len(self.frame):
+                raise Exception("Template payload slot out of range")
+        else:
+            l, k = name.split(".", 1)
+            if l not in self.offsets or k not in LAYERS[l]:
+                raise Exception("No such template field: {0}".format(name))
+            o, n, mask, shift = LAYERS[l][k]
+            a = self.offsets[l] + o
+            if mask is not None:
+                n = (mask.bit_length() + 7) // 8
+                word = codec.WORDS[n]
+
+        # Every layer starts on an even offset, so the 16-bit words of each
+        # checksum line up with those of the frame
+        w0 = a & ~1
+        w1 = (a + n + 1) & ~1
+        if w1 > len(self.frame):
+            # An odd payload: its last word is padded with a zero byte that
+            # isn't in the frame
+            self.view.release()
+            self.frame.append(0)
+            self.view = memoryview(self.frame)
+            self.length = len(self.frame) - 1
+
+        sums = []
+        for i, (c, s, e, udp) in enumerate(self.sums):
+            if w0 < e and w1 > s:
+                sums.append(i)
+            elif udp and name in PSEUDO:
+                # In the pseudo header. The protocol shares its word with the
+                # TTL, but only one of them changes at a time, so the word's
+                # change is the protocol's.
+                sums.append(i)
+
+        p = (a, n, word, mask, shift,
+             struct.Struct("!{0}H".format((w1 - w0) // 2)), w0, sums)
+        if isinstance(f, tuple):
+            self.fields[f] = p
+        q = self.fields.get(name, p)
+        if q is AMBIGUOUS or q[0:2] != (a, n):
+            p = AMBIGUOUS
+        self.fields[name] = p
+
+    # Patch values ({field: value}) into the frame, and return a view of it.
+    # The view is only valid until the next patch.
+    def patch(self, values):
+        b = self.frame
+        d = [0] * len(self.sums)
+
+        for k, v in values.items():
+            p = self.fields[k]
+            if p is AMBIGUOUS:
+                raise Exception("Template has several {0} slots, give each "
+                                "as (name, offset, size)".format(k))
+            a, n, word, mask, shift, words, w0, sums = p
+
+            old = words.unpack_from(b, w0)
+            if mask is None:
+                v = self.encode(k, v)
+                if len(v) != n:
+                    raise Exception("Template value for {0} must be {1} "
+                                    "bytes".format(k, n))
+                b[a:a+n] = v
+            else:
+                x = word.unpack_from(b, a)[0]
+                word.pack_into(b, a, (x & ~mask) | ((int(v) << shift) & mask))
+            new = words.unpack_from(b, w0)
+
+            if sums:
+                s = 0
+                for m in old:
+                    s += ~m & 0xffff
+                s += sum(new)
+                for i in sums:
+                    d[i] += s
+
+        for i, (c, s, e, udp) in enumerate(self.sums):
+            if not d[i]:
+                continue
+            x = ~codec.SHORT.unpack_from(b, c)[0] & 0xffff
+            x = ~checksum.fold(x + d[i]) & 0xffff
+            # A UDP checksum of zero means "none"; send its other form
+            if udp and not x:
+                x = 0xffff
+            codec.SHORT.pack_into(b, c, x)
+
+        if self.length is not None:
+            return self.view[:self.length]
+        return self.view
+
+    # A new frame with values patched in
+    def emit(self, values):
+        return bytes(self.patch(values))
+
+    def encode(self, k, v):
+        if isinstance(v, (bytes, bytearray, memoryview)):
+            return v
+        if isinstance(k, tuple) or k == PAYLOAD:
+            raise Exception("Template value for {0} must be bytes, not "
+                            "{1}".format(k, type(v).__name__))
+        if k.startswith("ether."):
+            return codec.mac_aton(v)
+        return codec.ip_aton(v)
@@ -1,4 +1,5 @@
-import socket
+from moops import codec
+from moops import checksum
 
 
 class UDP(dict):
@@ -13,8 +14,10 @@ class UDP(dict):
 
     # Not "exported"; internal use only
     __BYTES__ = "bytes"
-    __INT_PTR__ = "__ptr"
     __NEXTDATA__ = "__next"
+    __LAZY__ = "lazy"
+    __NUMERIC__ = "numeric"
+    __DISPATCH__ = "dispatch"
 
     __KEYS__ = [
         __LENGTH__,
@@ -31,35 +34,89 @@ class UDP(dict):
         __NAME__,
         __PREV__,
         __BYTES__,
-        __NEXTDATA__
+        __NEXTDATA__,
+        __LAZY__,
+        __NUMERIC__,
+        __DISPATCH__
+        ]
+
+    # Header fields, as opposed to bookkeeping keys
+    __FIELDS__ = [
+        __SRC__,
+        __DST__,
+        __LENGTH__,
+        __CHECKSUM__
         ]
 
     itemlist = None
-    inbount = False
+    inbound = False
+    dirty = False
+    lazy = False
+
+    # What our checksum currently covers, besides our own bytes: the pseudo
+    # header (or the network header it came from) and the payload object
+    pseudo = None
+    sumprev = None
+    sumdata = None
 
     def __init__(self, *args, **kw):
         dict.__init__(self, *args, **kw)
         self.itemlist = super(UDP, self).keys()
-        self[self.__NAME__] = "UDP"
+        dict.__setitem__(self, self.__NAME__, "UDP")
 
         if self.__BYTES__ in self.itemlist:
             self.inbound = True
+            self.lazy = bool(dict.get(self, self.__LAZY__))
             self.parse()
 
+    # Track whether a parsed header has been touched, so an untouched one can
+    # be handed back without being rebuilt
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, v)
+        if k in self.__FIELDS__:
+            self.dirty = True
+            if codec.ASSIGNED.log is not None:
+                codec.ASSIGNED.log.append((self, k))
+
+    # In lazy mode a field is only decoded from the received bytes the first
+    # time it's read, and then cached like any other key
+    def __missing__(self, k):
+        if not self.lazy or k not in self.__FIELDS__:
+            raise KeyError(k)
+        v = self.parsefield(k)
+        dict.__setitem__(self, k, v)
+        return v
+
+    def __contains__(self, k):
+        if dict.__contains__(self, k):
+            return True
+        if not self.lazy or k not in self.__FIELDS__:
+            return False
+        try:
+            self[k]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, k, d=None):
+        if k in self:
+            return self[k]
+        return d
+
     def __hash__(self):
         return hash(tuple(sorted(self.items())))
 
     def __eq__(self, x):
-        udp = UDP({self.__BYTES__: x})
-        udp.parse()
+        # Only the fields we compare against get decoded
+        udp = UDP({self.__BYTES__: x, self.__LAZY__: True})
         for i in self.itemlist:
             if i in self.__SKIP__:
                 continue
             if i not in udp or self[i] != udp[i]:
                 return False
 
-            if self.__NEXT__ in self.itemlist:
-                return self[self.__NEXT__] == udp.next()
+        if self.__NEXT__ in self.itemlist:
+            return self[self.__NEXT__] == udp.next()
 
         return True
 
@@ -67,18 +124,53 @@ class UDP(dict):
         raise Exception("WHAT")
 
     def __bytes__(self):
-        # Now, generate the summable header
-        b = b''
-        b += self.convert_port(self.__SRC__)
-        b += self.convert_port(self.__DST__)
-        b += self.convert_length()
-        b += self.convert_checksum(b)
-
-        b += self.getnext()
+        if self.pristine():
+            return bytes(self[self.__BYTES__])
+
+        b = bytearray(self.size())
+        self.pack_into(b)
+        return bytes(b)
+
+    # How many bytes pack_into() will write, for us and every layer above
+    def size(self):
+        if self.pristine():
+            return len(self[self.__BYTES__])
+
+        if self.lazy:
+            self.decode()
+
+        # The length may pad the payload
+        self.convert_length()
+        return codec.UDP.size + self.nextsize()
+
+    # Serialize the datagram into b at offset o (see Ether.pack_into())
+    def pack_into(self, b, o=0):
+        if self.pristine():
+            x = self[self.__BYTES__]
+            n = len(x)
+            b[o:o+n] = x
+            return n
+
+        if self.lazy:
+            self.decode()
+
+        # Now, generate the summable header. The length goes first as it may
+        # pad the payload.
+        l = self.convert_length()
+        n = codec.UDP.size + self.packnext(b, o + codec.UDP.size)
+        codec.UDP.pack_into(b, o,
+                            self.convert_port(self.__SRC__),
+                            self.convert_port(self.__DST__),
+                            l,
+                            0)
+
+        # The checksum covers the header, so it's patched in last
+        m = memoryview(b)[o:o+n]
+        codec.SHORT.pack_into(b, o + 6, self.convert_checksum(m) & 0xffff)
 
         # Ready!
-        self[self.__BYTES__] = b
-        return b
+        self[self.__BYTES__] = m
+        return n
 
     # This represent the keys that alter the behavior of the module
     def moops_keys(self):
@@ -95,9 +187,9 @@ class UDP(dict):
     def pad_data(self, n):
         # This must be adjusted when we add app layers
         if self.__NEXTDATA__ in self.itemlist:
-            p = self[self.__NEXTDATA__]
-            p += bytes(n)
-            self[self.__NEXTDATA__] = p
+            # The payload may be a view into a shared buffer, so copy it here,
+            # now that it's being changed
+            self[self.__NEXTDATA__] = bytes(self[self.__NEXTDATA__]) + bytes(n)
 
     def setnext(self, x):
         self[self.__NEXT__] = x
@@ -110,41 +202,73 @@ class UDP(dict):
             return b''
         return bytes(self[self.__NEXT__])
 
+    # Our payload as it will be serialized, short of serializing it
+    def nextobject(self):
+        if self.__NEXT__ not in self.itemlist:
+            return self.next()
+        x = self[self.__NEXT__]
+        if hasattr(x, 'pack_into'):
+            return x
+        if not isinstance(x, (bytes, bytearray, memoryview)):
+            x = bytes(x)
+        return x
+
+    def nextsize(self):
+        x = self.nextobject()
+        if hasattr(x, 'pack_into'):
+            return x.size()
+        return len(x)
+
+    def packnext(self, b, o):
+        x = self.nextobject()
+        if hasattr(x, 'pack_into'):
+            return x.pack_into(b, o)
+        b[o:o+len(x)] = x
+        return len(x)
+
+    # An inbound header that hasn't been modified since it was parsed, and
+    # whose upper layer (if any) is still the one parsed from our own data,
+    # can reuse the received bytes as they are.
+    def pristine(self):
+        if not self.inbound or self.dirty:
+            return False
+
+        # Our checksum covers the pseudo header, so the network layer must be
+        # untouched as well
+        p = self.get(self.__PREV__)
+        if p is not None and getattr(p, 'dirty', False):
+            return False
+
+        if self.__NEXT__ not in self.itemlist:
+            return True
+
+        n = self[self.__NEXT__]
+        if not hasattr(n, 'pristine') or not n.pristine():
+            return False
+        return n.get(self.__BYTES__) is self.next()
+
     def convert_port(self, n):
         a = 53
         if n in self.itemlist:
             a = self[n]
-        return bytes([(a >> 8) & 0xff, (a & 0xff)])
+        return a
 
     def generate_checksum(self, b):
         if self.__PREV__ not in self.itemlist:
             raise Exception("udp.generate_checksum: no prev")
 
-        # Apply the pseudo header
-        b = self[self.__PREV__].pseudoheader(len(b)) + b
-
-        s = 0
-        i = 0
-        c = len(b)
-        while c > 1:
-            s += int.from_bytes(b[i:i+2], "big")
-            i += 2
-            c -= 2
-
-        if c > 0:
-            s += int.from_bytes(b[i:i+1], "big")
-
-        while (s >> 16) != 0:
-            s = (s & 0xffff) + (s >> 16)
-
-        return ~s
+        # Apply the pseudo header. It's summed on its own, so the datagram
+        # isn't copied just to prepend it.
+        s = checksum.sum16(self[self.__PREV__].pseudoheader(len(b)))
+        # Zero means "no checksum" (RFC 768); send its other form
+        return checksum.compute(b, s) or 0xffff
 
     def convert_length(self):
         x = 0
         # Calculate the size of the full packet if the user doesn't want a
         # specific length.
         if self.__LENGTH__ not in self.itemlist or self.inbound:
-            h = 8
+            h = codec.UDP.size
             d = len(self.next())
             x = h + d
             if (x & 1):
@@ -153,16 +277,53 @@ class UDP(dict):
         else:
             x = self[self.__LENGTH__]
 
-        return bytes([((x >> 8) & 0xff), (x & 0xff)])
+        return x
 
+    # Expects the whole datagram, with a zeroed checksum field
     def convert_checksum(self, b):
         x = 0
-        if self.__CHECKSUM__ not in self.itemlist or self.inbound:
-            x = self.generate_checksum(b + b'\x00\x00' + self.getnext())
+        if self.inbound:
+            x = self.update_checksum(b)
+        elif self.__CHECKSUM__ not in self.itemlist:
+            x = self.generate_checksum(b)
         else:
             x = self[self.__CHECKSUM__]
 
-        return bytes([((x >> 8) & 0xff), (x & 0xff)])
+        return x
+
+    # If only header fields (ours or the addresses in the pseudo header)
+    # changed since we were parsed or last built, patch the checksum with
+    # those words (RFC 1624) rather than summing the whole payload again.
+    def update_checksum(self, b):
+        if self.__PREV__ not in self.itemlist:
+            raise Exception("udp.update_checksum: no prev")
+
+        o = self[self.__BYTES__]
+        c = codec.SHORT.unpack_from(o, 6)[0]
+        n = self.nextobject()
+        p = self[self.__PREV__].pseudoheader(len(b))
+
+        # The sender summed the pseudo header with the datagram's length
+        # field, and only that many bytes. A buffer with more than that
+        # (e.g. Ethernet trailer padding) is summed again in full.
+        q = self.pseudo
+        if q is None and self.sumprev is not None:
+            s = self.sumprev
+            l = codec.SHORT.unpack_from(o, 4)[0]
+            if l == len(o):
+                q = codec.PSEUDO.pack(bytes(s[12:16]), bytes(s[16:20]), 0,
+                                      s[9], l)
+
+        # A zero checksum means the sender didn't compute one
+        if c == 0 or q is None or len(o) != len(b) or n is not self.sumdata:
+            c = self.generate_checksum(b)
+        else:
+            c = checksum.update(c, q, p)
+            c = checksum.update(c, o[0:6], b[0:6]) or 0xffff
+
+        self.pseudo = p
+        self.sumdata = n
+        return c
 
     def parse(self):
         if self.__BYTES__ not in self.itemlist:
@@ -170,39 +331,46 @@ class UDP(dict):
 
         # While we can theoretically send an invalid or short packet, there is
         # little value in parsing a packet that isn't full (some exceptions)
-        if len(self[self.__BYTES__]) < 8:
+        b = self[self.__BYTES__]
+        if len(b) < codec.UDP.size:
             raise Exception("Invalid packet length")
 
-        self[self.__INT_PTR__] = 0
-
-        self.parseshort(self.__SRC__)
-        self.parseshort(self.__DST__)
-        self.parseshort(self.__LENGTH__)
-        self.parseshort(self.__CHECKSUM__)
-        self.parsenext()
-
-        self.pop(self.__INT_PTR__, None)
-
-    def parsebyte(self, n):
-        p = self[self.__INT_PTR__]
-        self[n] = self[self.__BYTES__][p]
-        self[self.__INT_PTR__] = p + 1
-
-    def parseshort(self, n):
-        p = self[self.__INT_PTR__]
-        self[n] = (self[self.__BYTES__][p] << 8) | self[self.__BYTES__][p + 1]
-        self[self.__INT_PTR__] = p + 2
-
-    def parseint(self, n):
-        p = self[self.__INT_PTR__]
-        self[n] = ((self[self.__BYTES__][p] << 24) |
-                   (self[self.__BYTES__][p + 1] << 16) |
-                   (self[self.__BYTES__][p + 2] << 8) |
-                   (self[self.__BYTES__][p + 3]))
-
-        self[self.__INT_PTR__] = p + 4
-
-    def parsenext(self):
-        p = self[self.__INT_PTR__]
-        self[self.__NEXTDATA__] = self[self.__BYTES__][p:]
-        self[self.__INT_PTR__] = p + len(self[self.__NEXTDATA__])
+        # Fields that come off the wire go straight into the dict, past
+        # __setitem__, as they don't make us dirty
+        if not self.lazy:
+            s, d, l, c = codec.UDP.unpack_from(b)
+            dict.update(self, {
+                self.__SRC__: s,
+                self.__DST__: d,
+                self.__LENGTH__: l,
+                self.__CHECKSUM__: c,
+                })
+
+        dict.__setitem__(self, self.__NEXTDATA__, b[codec.UDP.size:])
+
+        # Remember what the received checksum was computed over
+        p = self.get(self.__PREV__)
+        if p is not None:
+            self.sumprev = p.get(self.__BYTES__)
+        self.sumdata = self[self.__NEXTDATA__]
+
+        # Everything set so far came off the wire
+        self.dirty = False
+
+    # Decode every field a lazy parse hasn't been asked for yet
+    def decode(self):
+        for i in self.__FIELDS__:
+            if i not in self.itemlist:
+                self.get(i)
+
+    def parsefield(self, n):
+        b = self[self.__BYTES__]
+        if n == self.__SRC__:
+            return codec.SHORT.unpack_from(b, 0)[0]
+        elif n == self.__DST__:
+            return codec.SHORT.unpack_from(b, 2)[0]
+        elif n == self.__LENGTH__:
+            return codec.SHORT.unpack_from(b, 4)[0]
+        elif n == self.__CHECKSUM__:
+            return codec.SHORT.unpack_from(b, 6)[0]
+        raise KeyError(n)
@@ -0,0 +1,186 @@
+from moops.ether import Ether as E
+from moops.ip import IP
+from moops.udp import UDP
+from moops.fling import Fling as F
+from moops.match import Match as M
+from moops.mangle import Mangle
+from moops.rules import RuleSet
+from moops import checksum
+from moops import pcap
+from moops import dispatch
+import platform
+import json
+import time
+import sys
+
+
+# Throughput and per-call latency of the hot paths, over a range of frame
+# sizes. Results are printed, and written as JSON if a file is given, so two
+# versions can be compared.
+#
+#   python tests/bench.py [number] [results.json]
+
+sizes = [64, 128, 512, 1500, 4096, 9000]
+
+number = 2000
+if len(sys.argv) > 1:
+    number = int(sys.argv[1])
+
+out = None
+if len(sys.argv) > 2:
+    out = sys.argv[2]
+
+
+# The stock Mangle's rewrite is the same for every frame of a flow, so it
+# can be planned per flow
+class Rewrite(Mangle):
+    planned = True
+
+
+def chain(n, dst=1234):
+    u = UDP({'next': bytes(i & 0xff for i in range(n - 42))})
+    u['src'] = 999
+    u['dst'] = dst
+    i = IP({'next': u})
+    i['src'] = '10.0.0.1'
+    i['dst'] = '10.0.0.2'
+    u['prev'] = i
+    e = E({'next': i})
+    e['dst'] = 'a0:bb:cc:dd:ee:f0'
+    e['src'] = '01:02:03:04:05:06'
+    return e
+
+
+# A frame as it would come off the wire, with its lengths filled in by a
+# round trip through the layers
+def wire(x):
+    e = dispatch.decode(x)
+    e['next']['ttl'] = e['next']['ttl']
+    return bytes(e)
+
+
+def template():
+    u = UDP()
+    u['dst'] = 1234
+    i = IP({'next': u})
+    i['dst'] = '10.0.0.2'
+    return E({'next': i})
+
+
+# n rules, one per UDP port, the last of them for the one chain() sends to
+def ruleset(n, dst=1234):
+    r = RuleSet()
+    for p in range(dst - n + 1, dst + 1):
+        u = UDP()
+        u['dst'] = p
+        i = IP({'next': u})
+        i['dst'] = '10.0.0.2'
+        r.add(E({'next': i}))
+    return r
+
+
+def parse(x):
+    e = E({'bytes': x})
+    i = IP({'bytes': e.next(), 'prev': e})
+    u = UDP({'bytes': i.next(), 'prev': i})
+    return e, i, u
+
+
+# Time f() number times, one call at a time
+def measure(f):
+    lat = []
+    clock = time.perf_counter_ns
+    for n in range(number):
+        t = clock()
+        f()
+        lat.append(clock() - t)
+
+    lat.sort()
+    total = sum(lat)
+    return {
+        "ops": number * 1e9 / total if total else 0,
+        "p50": lat[len(lat) // 2],
+        "p90": lat[len(lat) * 9 // 10],
+        "p99": lat[len(lat) * 99 // 100],
+        "max": lat[-1],
+        }
+
+
+def cases(n):
+    x = bytes(chain(n))
+    y = bytes(chain(n, dst=4321))
+    e, i, u = parse(x)
+    ip = x[14:34]
+    dgram = x[34:]
+    m = M({'match': template()})
+    rules = ruleset(1000)
+    mangle = Mangle().update
+    f = F({'match': M({'match': template()}), 'mangle': mangle})
+    flows = F({'match': M({'match': template()}), 'mangle': Rewrite(),
+               'flows': 1024})
+    memo = F({'match': M({'match': template()}), 'mangle': mangle,
+              'memo': 1024})
+    frames = [(0.0, wire(x)), (0.0, wire(y))] * 50
+
+    def reparse_ip():
+        IP({'bytes': e.next(), 'prev': e})
+
+    def reparse_udp():
+        UDP({'bytes': i.next(), 'prev': i})
+
+    def bytes_ip():
+        c = chain(n)
+        bytes(c['next'])
+
+    def bytes_udp():
+        c = chain(n)
+        bytes(c['next']['next'])
+
+    return {
+        "Ether.parse": lambda: E({'bytes': x}),
+        "IP.parse": reparse_ip,
+        "UDP.parse": reparse_udp,
+        "dispatch to IP.dst": lambda: dispatch.decode(x)['next']['dst'],
+        "bytes(Ether) pristine": lambda: bytes(e),
+        "bytes(Ether) built": lambda: bytes(chain(n)),
+        "bytes(IP) built": bytes_ip,
+        "bytes(UDP) built": bytes_udp,
+        "checksum.compute IP": lambda: checksum.compute(ip),
+        "checksum.compute UDP": lambda: checksum.compute(dgram),
+        "checksum.update": lambda: checksum.update(0x1234, ip[12:20],
+                                                   dgram[0:8]),
+        "Match hit": lambda: m == x,
+        "Match miss": lambda: m == y,
+        "RuleSet x1000 hit": lambda: rules.lookup(x),
+        "Mangle.update": lambda: mangle(x),
+        # 100 frames, half of them matched and mangled
+        "pipeline x100": lambda: pcap.replay(f, frames),
+        "pipeline x100 flows": lambda: pcap.replay(flows, frames),
+        "pipeline x100 memo": lambda: pcap.replay(memo, frames),
+        }
+
+
+results = {}
+for n in sizes:
+    for k, f in cases(n).items():
+        results.setdefault(k, {})[n] = measure(f)
+
+print("\nmoops benchmarks, ops/s and p50/p99 ns ({0} calls each)".format(
+    number))
+print("{0:<24}".format("") +
+      "".join("{0:>28}".format(n) for n in sizes))
+for k, r in results.items():
+    print("{0:<24}".format(k) +
+          "".join("{0:>10.0f} {1:>8}/{2:<8}".format(
+              r[n]["ops"], r[n]["p50"], r[n]["p99"]) for n in sizes))
+
+if out:
+    with open(out, "w") as fp:
+        json.dump({
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "number": number,
+            "sizes": sizes,
+            "results": results,
+            }, fp, indent=1)
+    print("\nwrote {0}".format(out))
@@ -0,0 +1,39 @@
+from moops import checksum
+import random
+import timeit
+import sys
+
+
+# Compare the checksum backends against each other, and against what
+# checksum.sum16() picks, over a range of buffer sizes.
+#
+#   python tests/checksum.py [number]
+
+sizes = [8, 20, 28, 64, 128, 256, 576, 1024, 1500, 4096, 9000]
+
+number = 20000
+if len(sys.argv) > 1:
+    number = int(sys.argv[1])
+
+backends = dict(checksum.BACKENDS)
+backends["auto"] = checksum.sum16
+
+print("\nChecksum backends, ns per call ({0} calls each)".format(number))
+print("{0:>6} ".format("bytes") +
+      " ".join("{0:>11}".format(n) for n in backends))
+
+for n in sizes:
+    b = bytes(random.getrandbits(8) for i in range(n))
+
+    # Every backend must agree before its speed means anything
+    r = checksum.sum_struct(b)
+    for k, f in backends.items():
+        if f(b) != r:
+            raise Exception("{0}: wrong sum for {1} bytes".format(k, n))
+
+    row = []
+    for k, f in backends.items():
+        t = timeit.timeit(lambda: f(b), number=number)
+        row.append("{0:>11.0f}".format(t / number * 1e9))
+
+    print("{0:>6} ".format(n) + " ".join(row))
@@ -4,17 +4,15 @@ from moops.udp import UDP
 from moops.fling import Fling as F
 from moops.match import Match as M
 from moops.mangle import Mangle
+from moops import dispatch
 import socket
 import time
 import sys
 
 
 def mangle(x):
-    e = E({'bytes': x})
-    i = IP({'bytes': e.next(), 'prev': e})
-    u = UDP({'bytes': i.next(), 'prev': i})
-    e['next'] = i
-    i['next'] = u
+    e = dispatch.decode(x, lazy=False)
+    i = e['next']
 
     e['src'] = '00:11:22:33:44:55'
     i['src'] = '192.168.127.3'